@@ -0,0 +1,247 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Benchmark the writer with synthetic books.
+
+The books are generated offline: articles, images and the wiki are
+faked, nothing is fetched. Every case scales one aspect of a book
+(number of articles, table size, images, math, source blocks) and is
+run in a fresh interpreter. The book is rendered with
+RlWriter.writeBook, a case fails if the writer falls back to the
+fail-safe rendering. Layout and build are interleaved, every case
+reports
+
+images: seconds the layout waited for the images prepared in the image pool
+layout: seconds spent laying out the articles, without spooling and images
+spool: seconds spent pickling the laid out segments to the spool
+spool_kb: size of the spool
+build: seconds spent in the document backend, including the appendix
+toc: seconds to render and merge the table of contents
+peak_rss_kb: peak resident memory of the run
+wrap_hit_rate: share of the flowable sizes taken from the wrap cache
+
+usage: bench_books.py [--scale N] [--case NAME] [--json FILENAME] [--baseline FILENAME]
+
+With --baseline the results are compared to a stored run and the exit
+code is 1 if any time got slower than --threshold times the baseline.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import itertools
+import subprocess
+import optparse
+import resource
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# the fake wiki, image DB and environment are shared with the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tests'))
+from fakebook import FakeEnv, FakeImageDB, FakeStatus
+
+# number of articles and of elements per article
+CASES = {
+    'small': dict(articles=5),
+    'articles': dict(articles=100),
+    'tables': dict(articles=5, table_rows=100),
+    'images': dict(articles=5, images=20),
+    'math': dict(articles=5, math=50),
+    'source': dict(articles=5, sources=20),
+}
+
+CASE_DEFAULTS = dict(articles=1, paragraphs=10, table_rows=0, images=0, math=0, sources=0, chapters=1)
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipisici elit sed eiusmod tempor '
+         'incidunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud').split()
+
+
+def makeArticle(rng, num, case):
+    """Return the wikitext of a synthetic article"""
+    def sentence():
+        return ' '.join(rng.choice(WORDS) for i in range(rng.randint(5, 20))).capitalize() + '.'
+
+    def paragraph():
+        return ' '.join(sentence() for i in range(rng.randint(2, 6)))
+
+    lines = [paragraph()]
+    for i in range(case['paragraphs']):
+        if i % 4 == 0:
+            lines.append('== Section %d ==' % i)
+        lines.append(paragraph() + ' See [[Article %d]].' % rng.randint(0, case['articles'] - 1))
+    for i in range(case['images']):
+        lines.append('[[Image:Image%d_%d.png|thumb|%s]]' % (num, i, sentence()))
+        lines.append(paragraph())
+    for i in range(case['math']):
+        lines.append('<math>\\sum_{k=0}^{%d} x_k^2 = \\frac{a_%d}{b}</math> %s' % (i, i, sentence()))
+    for i in range(case['sources']):
+        lines.append('<source lang="python">\n%s\n</source>' % '\n'.join(
+            'def f%d(x):\n    return x * %d' % (j, j) for j in range(5)))
+    if case['table_rows']:
+        lines.append('{| class="wikitable"')
+        lines.append('! ' + ' !! '.join('Column %d' % c for c in range(4)))
+        for r in range(case['table_rows']):
+            lines.append('|-')
+            lines.append('| ' + ' || '.join(' '.join(rng.choice(WORDS) for w in range(rng.randint(1, 4)))
+                                            for c in range(4)))
+        lines.append('|}')
+    return '\n\n'.join(lines)
+
+
+def makeEnv(case, tmpdir, seed=42):
+    rng = random.Random(seed)
+    articles = {}
+    items = []
+    per_chapter = max(1, case['articles'] // max(1, case['chapters']))
+    for num in range(case['articles']):
+        articles[u'Article %d' % num] = makeArticle(rng, num, case)
+        if case['chapters'] and num % per_chapter == 0:
+            items.append(('chapter', u'Chapter %d' % (num // per_chapter)))
+        items.append(('article', u'Article %d' % num))
+    return FakeEnv(articles, images=FakeImageDB(tmpdir), items=items, title=u'Benchmark')
+
+
+def timedIter(iterable, timer):
+    """Yield the items of iterable and add the time spent in it to timer[0]"""
+    it = iter(iterable)
+    while True:
+        stime = time.time()
+        try:
+            item = it.next()
+        finally:
+            timer[0] += time.time() - stime
+        yield item
+
+
+def timedCall(func, timer):
+    def call(*args, **kwargs):
+        stime = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer[0] += time.time() - stime
+    return call
+
+
+def runCase(name, scale=1):
+    """Render one case in this process and return its measurements"""
+    from mwlib.rl.rlwriter import RlWriter
+    from mwlib.rl.pipeline import ElementSpool
+    from mwlib.rl.wrapcache import wrap_cache
+
+    case = dict(CASE_DEFAULTS)
+    case.update(CASES[name])
+    case['articles'] = case['articles'] * scale
+    tmpdir = tempfile.mkdtemp()
+    try:
+        env = makeEnv(case, tmpdir)
+        output = os.path.join(tmpdir, 'bench.pdf')
+        rw = RlWriter(env)
+        images, layout, toc, spool = [0.0], [0.0], [0.0], [0.0]
+        spool_size = [0]
+        append = ElementSpool.append
+        def spoolAppend(self, info, elements):
+            idx = append(self, info, elements)
+            spool_size[0] += self.sizes[idx]
+            return idx
+        ElementSpool.append = timedCall(spoolAppend, spool)
+        iterBookElements = rw.iterBookElements
+        rw.iterBookElements = lambda *args, **kwargs: timedIter(iterBookElements(*args, **kwargs), layout)
+        rw.collectArticleImages = timedCall(rw.collectArticleImages, images)
+        rw.toc_renderer.build = timedCall(rw.toc_renderer.build, toc)
+        stime = time.time()
+        rw.writeBook(output, status_callback=FakeStatus())
+        total = time.time() - stime
+        if rw.fail_safe_rendering:
+            raise RuntimeError('case %r was rendered with the fail-safe rendering' % name)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return {'images': images[0],
+            'layout': layout[0] - spool[0] - images[0], # both happen while the book is laid out
+            'spool': spool[0],
+            'spool_kb': spool_size[0] // 1024,
+            'build': total - layout[0] - toc[0],
+            'toc': toc[0],
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'wrap_hit_rate': wrap_cache.stats()['hit_rate'],
+            'case': case,
+            }
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of every time to the baseline.
+
+    @returns: True if no time is slower than threshold times the baseline
+    """
+    ok = True
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric in ['images', 'layout', 'spool', 'build', 'toc', 'peak_rss_kb']:
+            old, new = baseline[name].get(metric), results[name][metric]
+            if not old:
+                continue
+            ratio = new / float(old)
+            flag = ''
+            if metric != 'peak_rss_kb' and ratio > threshold:
+                flag = '  SLOWER'
+                ok = False
+            print '%-10s %-12s %10.3f -> %10.3f  x%.2f%s' % (name, metric, old, new, ratio, flag)
+    return ok
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--scale', type='int', default=1,
+                      help='multiply the number of articles of every case')
+    parser.add_option('--case', action='append', dest='cases',
+                      help='run only this case (can be given more than once)')
+    parser.add_option('--json', help='write the results to FILENAME')
+    parser.add_option('--baseline', help='compare the results with those in FILENAME')
+    parser.add_option('--threshold', type='float', default=1.2,
+                      help='allowed slowdown compared to the baseline (default 1.2)')
+    parser.add_option('--run-case', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.run_case:
+        print json.dumps(runCase(options.run_case, scale=options.scale))
+        return
+
+    results = {}
+    failed = []
+    for name in options.cases or sorted(CASES):
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--run-case', name, '--scale', str(options.scale)],
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            print '%-10s FAILED, exit code %d' % (name, p.returncode)
+            failed.append(name)
+            continue
+        # the writer logs to stdout, the result is the last line
+        results[name] = json.loads(out.strip().splitlines()[-1])
+        r = results[name]
+        print '%-10s images %7.3fs layout %7.3fs spool %6.3fs (%6d kB) build %7.3fs toc %6.3fs peak rss %8d kB wrap hits %3d%%' % (
+            name, r['images'], r['layout'], r['spool'], r['spool_kb'], r['build'], r['toc'], r['peak_rss_kb'],
+            100 * r.get('wrap_hit_rate', 0))
+
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=2, sort_keys=True)
+    if options.baseline:
+        if not compare(results, json.load(open(options.baseline)), options.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
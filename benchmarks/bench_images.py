@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Compare the repair of broken images with PIL to the former repair
+with convert subprocesses.
+
+Every image of the corpus directories is copied to a temp dir and
+repaired with both implementations. Images which need no repair are
+skipped unless --all is given.
+
+usage: bench_images.py [--runs N] [--all] DIR [DIR...]
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+from PIL import Image as PilImage
+
+from mwlib.rl import imageprep
+
+
+def convertRepairImage(img_path):
+    """repairImage as it was before the repair was done with PIL"""
+    try:
+        img = PilImage.open(img_path)
+    except IOError:
+        return -1
+    cmds = []
+    base_cmd = [
+        'convert',
+        '-limit', 'memory', '32000000',
+        '-limit', 'map', '64000000',
+        '-limit', 'disk', '64000000',
+        '-limit', 'area', '64000000',
+        ]
+    if img.info.get('interlace', 0) == 1:
+        cmds.append(base_cmd + [img_path, '-interlace', 'none', img_path])
+    if img.mode == 'P':
+        cmds.append(base_cmd + [img_path, img_path])
+    if img.mode == 'LA':
+        cleaned = PilImage.new('LA', img.size)
+        new_data = []
+        for pixel in img.getdata():
+            if pixel[1] == 0:
+                new_data.append((255,0))
+            else:
+                new_data.append(pixel)
+        cleaned.putdata(new_data)
+        cleaned.save(img_path)
+        img = PilImage.open(img_path)
+    if img.mode == 'RGBA':
+        cmds.append(base_cmd+['-background', 'white',
+                              '-alpha', 'Background',
+                              '-alpha', 'off',
+                              img_path,
+                              img_path])
+    for cmd in cmds:
+        ret = subprocess.call(cmd)
+        if ret != 0:
+            return ret
+    del img
+    PilImage.open(img_path).load()
+    return 0
+
+
+def pilRepairImage(img_path):
+    """imageprep._repairImage with the return codes of convertRepairImage"""
+    if imageprep._repairImage(img_path):
+        return 0
+    return -1
+
+
+def needsRepair(path):
+    try:
+        img = PilImage.open(path)
+    except IOError:
+        return False
+    return img.info.get('interlace', 0) == 1 or img.mode in ('P', 'LA', 'RGBA')
+
+
+def findImages(dirs, all_images):
+    paths = []
+    for d in dirs:
+        for dirpath, dirnames, filenames in os.walk(d):
+            for fn in sorted(filenames):
+                path = os.path.join(dirpath, fn)
+                if all_images or needsRepair(path):
+                    paths.append(path)
+    return paths
+
+
+def timeRepair(repair, path, tmpdir, runs):
+    best = None
+    ret = None
+    for i in range(runs):
+        tmp_path = os.path.join(tmpdir, 'img' + os.path.splitext(path)[1])
+        shutil.copyfile(path, tmp_path)
+        stime = time.time()
+        try:
+            ret = repair(tmp_path)
+        except Exception, err:
+            ret = repr(err)
+        elapsed = time.time() - stime
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [--runs N] [--all] DIR [DIR...]')
+    parser.add_option('--runs', type='int', default=3,
+                      help='number of runs per image, the best is reported (default 3)')
+    parser.add_option('--all', action='store_true',
+                      help='also time images which need no repair')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no corpus directory given')
+
+    paths = findImages(args, options.all)
+    tmpdir = tempfile.mkdtemp(prefix='bench_images')
+    total_old = total_new = 0.0
+    try:
+        for path in paths:
+            old, old_ret = timeRepair(convertRepairImage, path, tmpdir, options.runs)
+            new, new_ret = timeRepair(pilRepairImage, path, tmpdir, options.runs)
+            total_old += old
+            total_new += new
+            try:
+                mode = PilImage.open(path).mode
+            except IOError:
+                mode = '?'
+            print '%-40s %-5s convert %8.3fs (%s) pil %8.3fs (%s)' % (
+                os.path.basename(path)[:40], mode, old, old_ret, new, new_ret)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print 'images:  %d' % len(paths)
+    print 'convert: %.3fs' % total_old
+    print 'pil:     %.3fs' % total_new
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Measure the startup cost of the writer.
+
+Every measurement runs in a fresh interpreter:
+
+import: python -c "import mwlib.rl.rlwriter"
+first_job: import, create a writer and lay out a short article
+
+usage: bench_startup.py [-n RUNS] [--json FILENAME]
+"""
+
+import os
+import sys
+import time
+import subprocess
+import optparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+IMPORT_CODE = 'import mwlib.rl.rlwriter'
+
+WIKITEXT = """
+== Section ==
+Some text with a [[link]], <b>bold</b> and <i>italic</i> text.
+* an item
+* another item
+
+{|
+| a cell || another cell
+|}
+"""
+
+FIRST_JOB_CODE = '''
+from mwlib import uparser, advtree
+from mwlib.treecleaner import TreeCleaner
+from mwlib.rl.rlwriter import RlWriter
+tree = uparser.parseString(title='Test', raw=%r)
+advtree.buildAdvancedTree(tree)
+tc = TreeCleaner(tree)
+tc.cleanAll()
+rw = RlWriter(test_mode=True)
+rw.wikiTitle = 'testwiki'
+rw.write(tree)
+''' % WIKITEXT
+
+
+def timeCode(code, runs):
+    times = []
+    for i in range(runs):
+        stime = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        times.append(time.time() - stime)
+    times.sort()
+    return {'min': times[0],
+            'median': times[len(times)//2],
+            'runs': runs,
+            }
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n RUNS] [--json FILENAME]')
+    parser.add_option('-n', '--runs', type='int', default=5,
+                      help='number of runs per measurement (default 5)')
+    parser.add_option('--json', help='write the results to FILENAME')
+    options, args = parser.parse_args()
+
+    results = {'import': timeCode(IMPORT_CODE, options.runs),
+               'first_job': timeCode(FIRST_JOB_CODE, options.runs),
+               }
+    for name in ['import', 'first_job']:
+        print '%-10s min %.3fs median %.3fs' % (name, results[name]['min'], results[name]['median'])
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Measure the per node overhead of RlWriter.write on a large article.
+
+The article is written with the dispatch table of RlWriter.write and
+with the former dispatch, which looked up the write method by name and
+asked the formatter for styles and checked the text direction for every
+node.
+
+usage: bench_write.py [--paragraphs N] [--runs N]
+"""
+
+import time
+import optparse
+
+from mwlib import uparser, advtree, writerbase
+from mwlib.treecleaner import TreeCleaner
+from mwlib.rl.rlwriter import RlWriter, log
+
+
+class NameDispatchWriter(RlWriter):
+    """RlWriter with the dispatch used before the handler table"""
+
+    def write(self, obj):
+        m = "write" + obj.__class__.__name__
+        if not hasattr(self, m):
+            log.error('unknown node:', repr(obj.__class__.__name__))
+            if self.strict:
+                raise writerbase.WriterError('Unkown Node: %s ' % obj.__class__.__name__)
+            return []
+        m = getattr(self, m)
+        styles = self.formatter.setStyle(obj)
+        original = self.check_direction(obj)
+        res = m(obj)
+        self.set_rtl(original)
+        self.formatter.resetStyle(styles)
+        return res
+
+
+def makeTree(paragraphs):
+    raw = []
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            raw.append('== Section %d ==' % i)
+        sentence = ("Some text with a [[link %d]], <b>bold</b>, <i>italic</i> and "
+                    "<span style=\"color:red\">styled</span> words. " % i)
+        raw.append(sentence * 3)
+        if i % 5 == 0:
+            raw.append('* item\n* another <i>item</i>\n** nested item')
+    tree = uparser.parseString(title='Benchmark', raw='\n\n'.join(raw))
+    advtree.buildAdvancedTree(tree)
+    tc = TreeCleaner(tree)
+    tc.cleanAll()
+    return tree
+
+
+def timeWrite(writer_class, tree, runs):
+    best = None
+    for i in range(runs):
+        rw = writer_class(test_mode=True)
+        rw.wikiTitle = 'testwiki'
+        stime = time.time()
+        rw.write(tree)
+        elapsed = time.time() - stime
+        rw.cleanup()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [--paragraphs N] [--runs N]')
+    parser.add_option('--paragraphs', type='int', default=2000,
+                      help='number of paragraphs of the article (default 2000)')
+    parser.add_option('--runs', type='int', default=5,
+                      help='number of runs, the best is reported (default 5)')
+    options, args = parser.parse_args()
+
+    tree = makeTree(options.paragraphs)
+    nodes = len(list(tree.allchildren()))
+    old = timeWrite(NameDispatchWriter, tree, options.runs)
+    new = timeWrite(RlWriter, tree, options.runs)
+    print 'nodes:          %d' % nodes
+    print 'name dispatch:  %.3fs' % old
+    print 'handler table:  %.3fs' % new
+    print 'saved per node: %.2fus' % ((old - new) / nodes * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,31 +19,62 @@ except ImportError:
 #     'doc_key': 'font-weight: bold; display: inline;', 
 #     }
 
-class CustomNodeTransformer(object):
-
-    def __init__(self):
-        pass
+def compileCSSMap(css_map):
+    """Parse the style strings of a css map.
 
-    def _updateStyles(self, node, styles):
-        node_style = node.vlist.get('style', {})
+    @returns: dict mapping node class to dict of style name and value,
+    classes without any style are left out
+    """
+    compiled = {}
+    for node_class, styles in css_map.items():
+        node_style = {}
         for style in styles.split(';'):
             try:
                 style_name, style_val = style.split(':', 1)
             except ValueError:
                 continue
             node_style[style_name.strip()] = style_val.strip()
-        node.vlist['style'] = node_style
+        if node_style:
+            compiled[node_class] = node_style
+    return compiled
+
+
+class CustomNodeTransformer(object):
+
+    def __init__(self, css_map=css_map):
+        self.css_styles = compileCSSMap(css_map)
+
+    def _updateStyles(self, node, node_style):
+        styles = node.vlist.get('style', {})
+        styles.update(node_style)
+        node.vlist['style'] = styles
 
-        
     def transformCSS(self, node):
-        if getattr(node, 'vlist', None) == None:
-            node_classes = []
-        else:
-            node_classes = node.vlist.get('class', '').split()
-
-        for node_class in node_classes:
-            if node_class in css_map:
-                self._updateStyles(node, css_map[node_class])        
-                
-        for c in node.children:
-            self.transformCSS(c)
+        """Apply the styles of css_map to node and all its descendants.
+
+        The classes found in the tree are collected first and nothing is
+        changed unless one of them has a style. The tree is walked with
+        an explicit stack, deep trees don't hit the recursion limit."""
+        css_styles = self.css_styles
+        if not css_styles:
+            return
+        classed_nodes = []
+        tree_classes = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            vlist = getattr(node, 'vlist', None)
+            if vlist:
+                node_classes = vlist.get('class')
+                if node_classes:
+                    node_classes = node_classes.split()
+                    classed_nodes.append((node, node_classes))
+                    tree_classes.update(node_classes)
+            stack.extend(reversed(node.children))
+        if tree_classes.isdisjoint(css_styles):
+            return
+        for node, node_classes in classed_nodes:
+            for node_class in node_classes:
+                node_style = css_styles.get(node_class)
+                if node_style is not None:
+                    self._updateStyles(node, node_style)
@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Size limited on-disk cache which is shared between rendering jobs.
+
+Entries are plain files named by their key. The modification time of a
+file is updated whenever the entry is used, so that the least recently
+used entries are evicted first once the cache grows above its size limit.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+def _getUmask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# read once: changing the umask to read it is not thread safe
+_umask = _getUmask()
+
+
+class DiskCache(object):
+
+    def __init__(self, cache_dir, max_size=1024*1024*1024, suffix=''):
+        """
+        @param cache_dir: directory of the cache, created if missing
+        @param max_size: size limit of the cache in bytes
+        @param suffix: file name suffix of the cache entries
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._size = None # estimated size of the cache
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError: # created concurrently
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def getPath(self, key):
+        """Return the path of the entry for key or None if there is no such entry.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path, None) # mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def get(self, key):
+        """Return the content of the entry for key or None"""
+        path = self.getPath(key)
+        if path is None:
+            return None
+        try:
+            return open(path, 'rb').read()
+        except IOError:
+            return None
+
+    def _store(self, key, write):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                write(f)
+            finally:
+                f.close()
+            # mkstemp creates the file readable by its owner only, but
+            # the cache is shared between the rendering jobs
+            os.chmod(tmppath, 0644 & ~_umask)
+            os.rename(tmppath, path) # atomic, concurrent readers never see partial entries
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+        if self._size is not None:
+            self._size += os.path.getsize(path)
+        self.evict()
+        return path
+
+    def put(self, key, data):
+        """Store the string data as entry for key.
+
+        @returns: path of the entry
+        """
+        return self._store(key, lambda f: f.write(data))
+
+    def putFile(self, key, src_path):
+        """Store a copy of the file src_path as entry for key.
+
+        @returns: path of the entry
+        """
+        return self._store(key, lambda f: shutil.copyfileobj(open(src_path, 'rb'), f))
+
+    def _entries(self):
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.cache_dir):
+            for fn in filenames:
+                if fn.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is
+        below 90% of its size limit. The cache directory is only
+        scanned if the estimated size exceeds the limit."""
+        if self._size is not None and self._size <= self.max_size:
+            return
+        entries = self._entries()
+        self._size = sum(size for (mtime, size, path) in entries)
+        if self._size <= self.max_size:
+            return
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
@@ -113,6 +113,11 @@ except ImportError:
     pass
 
 
+# names of the fonts which are registered with reportlab. parsing the
+# TTF files is expensive and registration is global, so it's done once per process
+_registered_fonts = set()
+
+
 class RLFontSwitcher(FontSwitcher):
     warn_on_missing_fonts = True
 
@@ -204,6 +209,8 @@ class RLFontSwitcher(FontSwitcher):
         for font in font_list:
             if not font.get('name'):
                 continue
+            if font['name'] in _registered_fonts:
+                continue
             if font.get('type') == 'cid':
                 pdfmetrics.registerFont(UnicodeCIDFont(font['name']))
             else:
@@ -215,3 +222,4 @@ class RLFontSwitcher(FontSwitcher):
                     italic = font_variant in ['italic', 'bolditalic']
                     bold = font_variant in ['bold', 'bolditalic']
                     addMapping(font['name'], bold, italic, full_font_name)
+            _registered_fonts.add(font['name'])
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Cache of image metadata.
+
+The size, mode, format and interlace flag of an image are read from its
+header, PIL only decodes the pixel data on load(). Entries are checked
+against the modification time and the size of the file, so images
+rewritten by the repair or replaced by the image DB are probed again.
+"""
+
+import os
+
+from mwlib.rl.lrucache import LRUCache
+
+
+class ImageInfo(object):
+
+    def __init__(self, size, mode, format, interlaced):
+        self.size = size
+        self.mode = mode
+        self.format = format
+        self.interlaced = interlaced
+
+    def __repr__(self):
+        return '<ImageInfo %dx%d %s %s%s>' % (self.size[0], self.size[1], self.mode, self.format,
+                                              self.interlaced and ' interlaced' or '')
+
+
+class ImageInfoCache(object):
+
+    def __init__(self, max_entries=4096):
+        self._infos = LRUCache(max_entries=max_entries) # path -> (stat key, ImageInfo or None)
+        self.hits = 0
+        self.misses = 0
+
+    def _statKey(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _lookup(self, cache, path, stat_key):
+        entry = cache.get(path)
+        if entry is not None and stat_key is not None and entry[0] == stat_key:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def info(self, path):
+        """ImageInfo of the image at path or None if PIL can't open it"""
+        stat_key = self._statKey(path)
+        if stat_key is None:
+            return None
+        entry = self._lookup(self._infos, path, stat_key)
+        if entry is not None:
+            return entry[1]
+        from PIL import Image as PilImage
+        try:
+            img = PilImage.open(path)
+            info = ImageInfo(img.size, img.mode, img.format, img.info.get('interlace', 0) == 1)
+        except IOError:
+            info = None
+        self._infos.put(path, (stat_key, info))
+        return info
+
+    def invalidate(self, path):
+        """Call after path was rewritten"""
+        self._infos.put(path, (None, None))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                }
+
+
+# shared by all image consumers of a process
+image_info = ImageInfoCache()
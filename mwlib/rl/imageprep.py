@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Conversion of SVG images and repair of broken images.
+
+SVGs are converted by convert subprocesses, broken images are repaired
+with PIL. The writer runs prepareImage() for the images of upcoming
+articles in a process pool and only looks up the results during the
+layout. Images which were not prepared are handled during the layout
+with the same functions.
+
+If a DiskCache is given, converted and repaired images are stored in it
+keyed by the digest of the source file and the operations applied, so
+images used in many books are only processed once.
+"""
+
+import math
+import shutil
+import subprocess
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from mwlib import log
+from mwlib.rl.imageinfo import image_info
+
+log = log.Log('imageprep')
+
+# options of convert used to rasterize SVGs
+svg_convert_options = ["-flatten", "-coalesce",  "-strip"]
+
+# operations repairImage may apply. part of the cache keys, change it
+# whenever repairImage changes
+repair_operations = ['pil', 'deinterlace', 'palette-to-rgb', 'clean-la', 'composite-rgba-white']
+
+
+def fileDigest(path):
+    h = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(64*1024)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def cacheKey(digest, operations):
+    return sha1('%s\0%s' % (digest, '\0'.join(operations))).hexdigest()
+
+
+def convertSVG(img_path, cache=None):
+    """Rasterize an SVG image. The PNG is taken from cache if possible.
+
+    @returns: path of the PNG image or '' if the conversion failed
+    """
+    if cache is None:
+        return _convertSVG(img_path)
+    try:
+        key = cacheKey(fileDigest(img_path), ['svg'] + svg_convert_options)
+    except EnvironmentError:
+        return _convertSVG(img_path)
+    png_path = img_path + '.png'
+    cached = cache.getPath(key)
+    if cached is not None:
+        try:
+            shutil.copyfile(cached, png_path)
+            return png_path
+        except EnvironmentError, err:
+            log.warning('could not use cached image %r: %r' % (cached, err))
+    png_path = _convertSVG(img_path)
+    if png_path:
+        try:
+            cache.putFile(key, png_path)
+        except EnvironmentError, err:
+            log.warning('could not store image in cache: %r' % err)
+    return png_path
+
+
+def _convertSVG(img_path):
+    cmd = ["convert", img_path] + svg_convert_options + [img_path+".png"]
+    try:
+        p = subprocess.Popen(cmd, shell=False)
+        status = p.wait()
+        if status != 0 :
+            log.warning('img could not be converted. convert exited with non-zero return code:', repr(cmd))
+            return ''
+        else:
+            return '%s.png' % img_path
+    except OSError:
+        log.warning('img could not be converted. cmd failed:', repr(cmd))
+        return ''
+
+
+def repairedPath(img_path, fmt):
+    """Path a repaired image of format fmt is written to. Formats which
+    are not saved as they are become PNGs next to the original, like
+    converted SVGs."""
+    if fmt in ('PNG', 'TIFF', 'BMP'):
+        return img_path
+    return img_path + '.png'
+
+
+def repairImage(img_path, cache=None):
+    """Repair images which reportlab can't handle. Repaired images are
+    taken from cache if possible, failures are not cached.
+
+    @returns: path of the usable image or '' if the image can't be used
+    """
+    if cache is None:
+        return _repairImage(img_path)
+    try:
+        digest = fileDigest(img_path)
+    except EnvironmentError:
+        return _repairImage(img_path)
+    key = cacheKey(digest, repair_operations)
+    data = cache.get(key)
+    if data is not None:
+        if not data: # empty entries mark images which needed no repair
+            return img_path
+        info = image_info.info(img_path)
+        if info is None:
+            return _repairImage(img_path)
+        out_path = repairedPath(img_path, info.format)
+        f = open(out_path, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        image_info.invalidate(out_path)
+        return out_path
+    out_path = _repairImage(img_path)
+    if out_path:
+        try:
+            if out_path == img_path and fileDigest(img_path) == digest:
+                cache.put(key, '')
+            else:
+                cache.putFile(key, out_path)
+        except EnvironmentError, err:
+            log.warning('could not store image in cache: %r' % err)
+    return out_path
+
+
+def _repairImage(img_path):
+    from PIL import Image as PilImage
+    try:
+        img = PilImage.open(img_path)
+    except IOError:
+        log.warning('image can not be opened by PIL: %r' % img_path)
+        return ''
+    fmt = img.format
+    changed = False
+    if img.info.get('interlace', 0) == 1:
+        changed = True # saved without interlacing below
+    if img.mode == 'P': # ticket 324
+        if 'transparency' in img.info:
+            img = img.convert('RGBA')
+        else:
+            img = img.convert('RGB')
+        changed = True
+    if img.mode == 'LA': # ticket 429
+        # fully transparent pixels become white
+        lum, alpha = img.split()
+        lum.paste(255, None, alpha.point(lambda v: v == 0 and 255 or 0))
+        img = PilImage.merge('LA', (lum, alpha))
+        changed = True
+    if img.mode == 'RGBA':
+        # ticket 901, image: http://en.wikipedia.org/wiki/File:WiMAXArchitecture.svg
+        flat = PilImage.new('RGB', img.size, (255, 255, 255))
+        flat.paste(img, None, img.split()[3])
+        img = flat
+        changed = True
+
+    out_path = img_path
+    if changed:
+        out_path = repairedPath(img_path, fmt)
+        try:
+            img.save(out_path, fmt if out_path == img_path else 'PNG')
+        except (IOError, ValueError), err:
+            log.warning('repairing broken image failed (%r): %r' % (err, img_path))
+            return ''
+        image_info.invalidate(out_path)
+    try:
+        if changed:
+            del img
+            img = PilImage.open(out_path)
+        d = img.load()
+    except:
+        log.warning('image can not be opened by PIL: %r' % out_path)
+        raise
+    return out_path
+
+
+def resampleImage(img_path, width, height, dpi, cache=None):
+    """Downsample an image to dpi at a print size of width x height
+    points. Only the header is read if no resampling is needed.
+
+    @returns: path of the downsampled image, which is stored next to
+    img_path, or img_path if the image has no more pixels than needed
+    """
+    from PIL import Image as PilImage
+    info = image_info.info(img_path)
+    if info is None:
+        return img_path
+    img_width, img_height = info.size
+    scale = max(width * dpi / 72.0 / img_width, height * dpi / 72.0 / img_height)
+    if scale >= 0.9: # not worth the loss of a resampling
+        return img_path
+    size = (max(1, int(math.ceil(img_width * scale))),
+            max(1, int(math.ceil(img_height * scale))))
+    if info.format == 'JPEG' and info.mode in ('L', 'RGB', 'CMYK'):
+        fmt, ext = 'JPEG', 'jpg'
+    else:
+        fmt, ext = 'PNG', 'png'
+    out_path = '%s.%dx%d.%s' % (img_path, size[0], size[1], ext)
+    key = None
+    if cache is not None:
+        try:
+            key = cacheKey(fileDigest(img_path), ['resample', '%dx%d' % size, fmt])
+        except EnvironmentError:
+            pass
+        else:
+            cached = cache.getPath(key)
+            if cached is not None:
+                try:
+                    shutil.copyfile(cached, out_path)
+                    return out_path
+                except EnvironmentError, err:
+                    log.warning('could not use cached image %r: %r' % (cached, err))
+    try:
+        img = PilImage.open(img_path)
+        if img.mode not in ('L', 'RGB', 'CMYK', 'RGBA'):
+            if img.mode in ('LA', 'P') or 'transparency' in img.info:
+                img = img.convert('RGBA')
+            else:
+                img = img.convert('RGB')
+        img = img.resize(size, PilImage.ANTIALIAS)
+        if fmt == 'JPEG':
+            img.save(out_path, fmt, quality=90)
+        else:
+            img.save(out_path, fmt, optimize=True)
+    except (IOError, ValueError), err:
+        log.warning('could not resample image %r: %r' % (img_path, err))
+        return img_path
+    if key is not None:
+        try:
+            cache.putFile(key, out_path)
+        except EnvironmentError, err:
+            log.warning('could not store image in cache: %r' % err)
+    return out_path
+
+
+def prepareImage((disk_path, cache)):
+    """Convert and repair one image, runs in a worker process.
+
+    @returns: tuple (disk_path, path of the converted SVG or None,
+    utf-8 encoded path of the image, result of repairImage)
+    """
+    png_path = None
+    path = disk_path
+    if disk_path.lower().endswith('svg'):
+        path = png_path = convertSVG(disk_path, cache=cache)
+        if not png_path:
+            return (disk_path, '', None, None)
+    path = path.encode('utf-8')
+    try:
+        repaired_path = repairImage(path, cache=cache)
+    except Exception, err:
+        log.warning('image skipped: %r' % err)
+        repaired_path = ''
+    return (disk_path, png_path, path, repaired_path)
+
@@ -10,7 +10,13 @@
 # All the tex generation is handled by texcaller: 
 # https://github.com/vog/texcaller
 
-import texcaller
+import re
+from xml.sax.saxutils import unescape
+
+def escape_latex(txt):
+    # texcaller is only imported once an element is printed
+    import texcaller
+    return texcaller.escape_latex(txt)
 
 class SimpleElement:
     def __init__(self, text):
@@ -27,7 +33,7 @@ class Paragraph(SimpleElement):
         self.style = style
         self.bulletStyle = bulletStyle
     def __str__(self):
-        return texcaller.escape_latex(self.text)
+        return escape_latex(self.text)
     def __repr__(self):
         return self.__str__()
       
@@ -39,7 +45,7 @@ class Table(SimpleElement):
         for row in tabledata:
             escaped_row = []
             for cell in row:
-                escaped_row.append(texcaller.escape_latex(cell))
+                escaped_row.append(escape_latex(cell))
             content += u" & ".join(escaped_row)
             content += u'\\\\ \\hline \n'
             rowsCount = max(rowsCount, len(row))
@@ -63,7 +69,7 @@ class ListItem(SimpleElement):
             #return r"\item[%(c)s] %(t)s" % {'c': self.caption, 't': self.text}
             return ""
         else:
-            return u"\\item %s \\\\" % texcaller.escape_latex(self.text) # {'t': self.text} # texcaller.escape_latex(u"%r" % self.text)}
+            return u"\\item %s \\\\" % escape_latex(self.text) # {'t': self.text} # texcaller.escape_latex(u"%r" % self.text)}
             
 class List(SimpleElement):
     def __init__(self, items):
@@ -90,18 +96,65 @@ class Flowable(SimpleElement):
 class Preformatted(SimpleElement):
     def __init__(self, text, style, bulletStyle=None):
         SimpleElement.__init__(self, text)
+
+class XPreformatted(Preformatted):
+    # text with reportlab markup, printed verbatim without the markup
+    def __init__(self, text, style, bulletText=None):
+        Preformatted.__init__(self, text, style)
+        self.style = style
+    def plainText(self):
+        return unescape(re.sub(r'<[^>]*>', '', self.text))
+    def wrap(self, availWidth, availHeight):
+        # monospaced glyphs are about 0.6 em wide
+        lines = self.plainText().split('\n')
+        width = max(len(line) for line in lines) * 0.6 * self.style.fontSize
+        return width, len(lines) * self.style.leading
+    def __str__(self):
+        return u"\\begin{verbatim}\n%s\n\\end{verbatim}" % self.plainText().replace(u'\\end{verbatim}', u'\\end {verbatim}')
         
 class Figure(SimpleElement):
-    def __init__(self, text, style, bulletStyle=None):
-        SimpleElement.__init__(self, text)
-        
-class FiguresAndParagraphs(SimpleElement):
-    def __init__(self, text, style, bulletStyle=None):
-        SimpleElement.__init__(self, text)
-        
-class SmartKeepTogether(SimpleElement):
-    def __init__(self, text, style, bulletStyle=None):
-        SimpleElement.__init__(self, text)
+    def __init__(self, imgFile, captionTxt='', captionStyle=None, imgWidth=None, imgHeight=None,
+                 margin=(0, 0, 0, 0), padding=(0, 0, 0, 0), align=None, borderColor=None, url=None):
+        SimpleElement.__init__(self, captionTxt)
+        self.imgPath = imgFile
+        self.captionTxt = captionTxt
+        self.cs = captionStyle
+        self.imgWidth = imgWidth
+        self.imgHeight = imgHeight
+        self.margin = margin
+        self.padding = padding
+        self.align = align
+        self.borderColor = borderColor
+        self.url = url
+    def __str__(self):
+        txt = u"\\includegraphics[width=%.1fpt,height=%.1fpt]{%s}" % (self.imgWidth, self.imgHeight, self.imgPath)
+        if self.captionTxt:
+            txt += u"\\\\\n" + escape_latex(self.captionTxt)
+        return txt
+
+class _FlowableGroup(SimpleElement):
+    # printable flowables of a group, one per line
+    def __init__(self, flowables):
+        self.flowables = flowables
+    def __str__(self):
+        lines = []
+        for f in self.flowables:
+            try:
+                lines.append(u"%s" % f)
+            except AttributeError:
+                continue
+        return u"\n".join(lines)
+
+class FiguresAndParagraphs(_FlowableGroup):
+    def __init__(self, figures, paragraphs, figure_margin=(0, 0, 0, 0), rtl=False):
+        _FlowableGroup.__init__(self, figures + paragraphs)
+        self.fs = figures
+        self.ps = paragraphs
+        self.figure_margin = figure_margin
+        self.rtl = rtl
+
+class SmartKeepTogether(_FlowableGroup):
+    pass
         
 class MathElement(SimpleElement):
     def __init__(self, text, displayStyle=False, environment=None):
@@ -120,31 +173,53 @@ class MathElement(SimpleElement):
             return "$" +self.text + "$"
         
 class TocEntry(SimpleElement):
-    ''' valid lvl values
-        chapter ==> \chapter
-        group ==> \section
-        article ==> \subsection
+    ''' valid lvl values: chapter, group, article
+
+    The entry is printed as a marker which reports its page to the
+    document template, see latextemplate.BaseDocTemplate
     '''
     def __init__(self, txt, lvl=None, bulletStyle=None):
         SimpleElement.__init__(self, txt)
+        self.txt = txt
+        self.lvl = lvl
+        self.toc_idx = None # set by the document template
         
     def __str__(self):
-        if (self.lvld == 'chapter'):
-            return '\chapter{%s}' % self.text
-        elif (self.lvld == 'group'):
-            return '\subsection{%s}' % self.text
-        elif (self.lvld == 'article'):
-            return '\section{%s}' % self.text
+        if getattr(self, 'toc_idx', None) is None:
+            return u''
+        # \write is deferred to the shipout of the page the entry is on
+        return u'\\write16{mwlib-toc %d \\thepage}' % self.toc_idx
         
 class DummyTable(SimpleElement):
     def __init__(self, text, style, bulletStyle=None):
         SimpleElement.__init__(self, text)
         
-class HRFlowable:
-    def __init(self, width=1,color=1,thickness=1,lineCap=1):
-        self.text = 'HR'
-        return
-    def __str__(self):
-        return self.text
-    def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+class HRFlowable(SimpleElement):
+    def __init__(self, width='100%', thickness=1, **kwargs):
+        if isinstance(width, basestring) and width.endswith('%'):
+            width = '%.2f\\linewidth' % (float(width[:-1]) / 100)
+        else:
+            width = '%.1fpt' % width
+        SimpleElement.__init__(self, u"\\par\\noindent\\rule{%s}{%.2fpt}\\par" % (width, thickness))
+
+class Spacer(SimpleElement):
+    def __init__(self, width, height):
+        SimpleElement.__init__(self, u"\\vspace{%.1fpt}" % height)
+        self.width = width
+        self.height = height
+
+class PageBreak(SimpleElement):
+    def __init__(self):
+        SimpleElement.__init__(self, u"\\newpage")
+
+class NotAtTopPageBreak(SimpleElement):
+    # LaTeX drops a \newpage at the top of an empty page
+    def __init__(self):
+        SimpleElement.__init__(self, u"\\newpage")
+
+class CondPageBreak(SimpleElement):
+    # page breaks are left to LaTeX
+    def __init__(self, height):
+        SimpleElement.__init__(self, u"")
+        self.height = height
+
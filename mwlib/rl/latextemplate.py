@@ -7,8 +7,11 @@
 
 # All the tex generation is handled by texcaller: 
 # https://github.com/vog/texcaller
+# texcaller is only imported when a document is built
 
-import texcaller
+import re
+
+from mwlib.rl.latexelements import TocEntry
 
 #\usepackage[cm]{fullpage}
 #\usepackage[utf8]{inputenc}
@@ -31,37 +34,121 @@ r''
 ]
 
 basetempl = '\n'.join(basetempl)
+# the document is written in two parts, so that the content can be streamed in between
+basetempl_head, basetempl_tail = basetempl.split('%(content)s')
+
+# pdfTeX only: the keywords of the document info
+keywords_templ = r'\ifx\pdfinfo\undefined\else\pdfinfo{/Keywords (%s)}\fi'
+
+# shards of a book have unnumbered pages, only the first has the title.
+# the page numbers are stamped onto the stitched PDF
+shard_title_templ = {True: '\\pagestyle{empty}\\maketitle\\thispagestyle{empty}\n',
+                     False: '\\pagestyle{empty}\n'}
+
+# anchors in the reportlab markup of the elements, see RlWriter.addBookmark
+anchor_re = re.compile(r'<a name="([^"]+)"\s*/>')
+# a \write is deferred to the shipout of the page it is on
+dest_marker_templ = u'\\write16{mwlib-dest %s \\thepage}'
+
+# markers and the page count are read from the TeX log
+toc_marker_re = re.compile(r'mwlib-toc (\d+) (\d+)')
+dest_marker_re = re.compile(r'mwlib-dest (\S+) (\d+)')
+pages_re = re.compile(r'Output written on .*?\((\d+)\s+pages?', re.DOTALL)
 
 class BaseDocTemplate:
-    def __init__(self, filename, topMargin=0, leftMargin=0, rightMargin=0, bottomMargin=0):
+    def __init__(self, filename, topMargin=0, leftMargin=0, rightMargin=0, bottomMargin=0, title='',
+                 keywords='', status_callback=None, tocCallback=None, shard=None):
         self.filename = filename
+        self.title = title
+        self.keywords = keywords
+        self.status_callback = status_callback
+        # called with (lvl, txt, page) for every TocEntry once the pages are known
+        self.tocCallback = tocCallback
+        # index of the shard if only a part of the book is rendered
+        self.shard = shard
         self.templates = []
+        # known after the build: number of pages, page of every anchor
+        self.page_count = None
+        self.bookmark_pages = {}
     def addPageTemplates(self, pageTemplate):
         self.templates.append(pageTemplate)
     def build(self, flowables, filename=None):
-        # print printable flowables
-        strlist = []
-        for el in flowables:
-            try:
-                strlist.append("%s" %el)
-            except AttributeError:
-                next
-        content = '\n'.join(strlist)
-        content += u'\n'
-        
-        content = basetempl % {'content': content, 'title': 'FIXME Title'}
-        
-        #content = content.encode("utf8")
-        #assert 0
-        pdf, info = texcaller.convert(content, 'LaTeX', 'PDF', 5)
-        
+        # flowables can be any iterable. every flowable is written to the
+        # .tex file as soon as it is available, so the list of flowables
+        # never needs to be held in memory as a whole
         if filename:
             self.filename = filename
+        texpath = self.filename + '.tex'
+        toc_entries = []
+        f = open(texpath, 'w')
+        try:
+            head = basetempl_head % {'title': 'FIXME Title'}
+            if self.shard is not None:
+                head = head.replace('\\maketitle ', shard_title_templ[self.shard == 0])
+            f.write(head.encode('utf8'))
+            if self.keywords:
+                # these would end the PDF string or break the TeX source
+                keywords = re.sub(r'[\\(){}%#$&^_~]', '', self.keywords)
+                f.write((keywords_templ % keywords).encode('utf8'))
+                f.write('\n')
+            for el in flowables:
+                anchors = []
+                self.registerMarkers(el, toc_entries, anchors)
+                # print printable flowables
+                try:
+                    txt = u"%s" % el
+                except AttributeError:
+                    continue
+                f.write(txt.encode('utf8'))
+                f.write('\n')
+                for key in anchors:
+                    f.write((dest_marker_templ % key).encode('utf8'))
+                    f.write('\n')
+            f.write(basetempl_tail.encode('utf8'))
+        finally:
+            f.close()
+
+        if self.status_callback:
+            self.status_callback(progress=0)
+        import texcaller
+        # texcaller only takes the whole source as a string. it is plain
+        # text, far smaller than the elements it was printed from
+        content = open(texpath).read().decode('utf8')
+        pdf, info = texcaller.convert(content, 'LaTeX', 'PDF', 5)
+        del content
         open(self.filename, 'w').write(pdf)
         #open(self.filename+'.log', 'w').write(info)
-        open(self.filename+'.tex', 'w').write(content.encode("utf8"))
-        
-        # Save the pdf to self.filename!
+        self.afterBuild(info or '', toc_entries)
+
+    def registerMarkers(self, el, toc_entries, anchors):
+        # TocEntries and anchors can be nested in groups of flowables
+        if isinstance(el, TocEntry):
+            el.toc_idx = len(toc_entries)
+            toc_entries.append((el.lvl, el.txt))
+        else:
+            text = getattr(el, 'text', None)
+            if isinstance(text, basestring) and '<a name=' in text:
+                anchors.extend(anchor_re.findall(text))
+        for child in getattr(el, 'flowables', None) or []:
+            self.registerMarkers(child, toc_entries, anchors)
+
+    def afterBuild(self, info, toc_entries):
+        """Report the page count and the pages of the TOC entries and of
+        the anchors, which are taken from the log of the last TeX run"""
+        toc_pages = dict((int(idx), int(page)) for (idx, page) in toc_marker_re.findall(info))
+        if self.tocCallback:
+            for (idx, (lvl, txt)) in enumerate(toc_entries):
+                if idx in toc_pages:
+                    self.tocCallback((lvl, txt, toc_pages[idx]))
+        self.bookmark_pages = dict((key, int(page)) for (key, page) in dest_marker_re.findall(info))
+        pages = pages_re.findall(info)
+        if pages:
+            self.page_count = int(pages[-1])
+        if self.status_callback:
+            if self.page_count is not None:
+                self.status_callback(progress=100, page=self.page_count)
+            else:
+                self.status_callback(progress=100)
     
     
 class NextPageTemplate:
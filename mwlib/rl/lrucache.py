@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Size limited in-memory cache which evicts the least recently used entry."""
+
+
+class LRUCache(object):
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {} # key -> link
+        # circular doubly linked list of [prev, next, key, value], most recently used last
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        link = self._entries.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        prev, next, key, value = link
+        prev[1] = next
+        next[0] = prev
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return value
+
+    def put(self, key, value):
+        link = self._entries.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        root = self._root
+        if len(self._entries) >= self.max_entries:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._entries[oldest[2]]
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self._entries[key] = link
+
+    def clear(self):
+        self._entries.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Timing of the write methods of the writer.
+
+For every write method the number of calls, the cumulative time (time
+spent in the outermost active call, including nested calls) and the
+self time (excluding nested write calls) is recorded. For every article
+the layout time and the number of written nodes are recorded. The tree
+preparation passes (tree building, each tree cleaner method, css
+mapping) are recorded with their number of runs and total time.
+"""
+
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class NodeTimer(object):
+
+    def __init__(self):
+        self.methods = {} # name -> [calls, cumulative, self]
+        self.articles = [] # [caption, seconds, nodes]
+        self.passes = {} # name -> [runs, seconds]
+        self._stack = [] # [name, start, time of nested calls]
+        self._active = {} # name -> number of active calls
+        self._article = None
+
+    def enter(self, name):
+        self._stack.append([name, time.time(), 0.0])
+        self._active[name] = self._active.get(name, 0) + 1
+
+    def leave(self):
+        name, start, nested = self._stack.pop()
+        elapsed = time.time() - start
+        self._active[name] -= 1
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        if not self._active[name]: # recursive calls are already contained in the outermost one
+            stats[1] += elapsed
+        stats[2] += elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+        if self._article is not None:
+            self._article[2] += 1
+
+    def addPass(self, name, seconds):
+        stats = self.passes.get(name)
+        if stats is None:
+            stats = self.passes[name] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+
+    def startArticle(self, caption):
+        self._article = [caption, time.time(), 0]
+
+    def endArticle(self):
+        caption, start, nodes = self._article
+        self.articles.append([caption, time.time() - start, nodes])
+        self._article = None
+
+    def merge(self, other):
+        """Add the stats of another timer, e.g. of a layout worker"""
+        for name, (calls, cum, own) in other.methods.items():
+            stats = self.methods.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += calls
+            stats[1] += cum
+            stats[2] += own
+        self.articles.extend(other.articles)
+        for name, (runs, seconds) in other.passes.items():
+            stats = self.passes.setdefault(name, [0, 0.0])
+            stats[0] += runs
+            stats[1] += seconds
+
+    def report(self):
+        methods = dict((name, {'calls': calls, 'cumulative': cum, 'self': own})
+                       for (name, (calls, cum, own)) in self.methods.items())
+        articles = [{'title': caption, 'seconds': seconds, 'nodes': nodes}
+                    for (caption, seconds, nodes) in sorted(self.articles, key=lambda a: -a[1])]
+        passes = dict((name, {'runs': runs, 'seconds': seconds})
+                      for (name, (runs, seconds)) in self.passes.items())
+        return {'methods': methods, 'articles': articles, 'passes': passes}
+
+    def summary(self, num=10):
+        """Return the methods with the highest self time and the
+        slowest preparation passes as text"""
+        lines = ['%-30s %8s %10s %10s' % ('method', 'calls', 'cumul.', 'self')]
+        for name, (calls, cum, own) in sorted(self.methods.items(), key=lambda i: -i[1][2])[:num]:
+            lines.append('%-30s %8d %10.3f %10.3f' % (name, calls, cum, own))
+        if self.passes:
+            lines.append('%-30s %8s %10s' % ('pass', 'runs', 'seconds'))
+            for name, (runs, seconds) in sorted(self.passes.items(), key=lambda i: -i[1][1])[:num]:
+                lines.append('%-30s %8d %10.3f' % (name, runs, seconds))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        f = open(filename, 'w')
+        try:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
@@ -6,7 +6,6 @@
 
 from __future__ import division
 
-from PIL import Image
 from time import gmtime, strftime
 
 from reportlab.platypus.paragraph import Paragraph
@@ -19,6 +18,7 @@ from mwlib.rl.pdfstyles import header_margin_hor, header_margin_vert, footer_mar
 from mwlib.rl.pdfstyles import pagefooter, titlepagefooter, serif_font
 from mwlib.rl import pdfstyles
 from mwlib.rl.customflowables import TocEntry
+from mwlib.rl.imageinfo import image_info
 
 from reportlab.lib.pagesizes import  A3
 
@@ -26,12 +26,20 @@ from mwlib.rl.pdfstyles import text_style
 
 from mwlib.rl import fontconfig
 from mwlib.rl.formatter import RLFormatter
-font_switcher = fontconfig.RLFontSwitcher()
-font_switcher.font_paths = fontconfig.font_paths
-font_switcher.registerDefaultFont(pdfstyles.default_font)
-font_switcher.registerFontDefinitionList(fontconfig.fonts)
 
-formatter = RLFormatter(font_switcher=font_switcher)
+_formatter = None
+
+def getFormatter():
+    """Formatter for headers and footers. Created on first use, so that
+    importing this module doesn't set up fonts."""
+    global _formatter
+    if _formatter is None:
+        font_switcher = fontconfig.RLFontSwitcher()
+        font_switcher.font_paths = fontconfig.font_paths
+        font_switcher.registerDefaultFont(pdfstyles.default_font)
+        font_switcher.registerFontDefinitionList(fontconfig.fonts)
+        _formatter = RLFormatter(font_switcher=font_switcher)
+    return _formatter
 
 def _doNothing(canvas, doc):
     "Dummy callback for onPage"
@@ -101,7 +109,7 @@ class WikiPage(PageTemplate):
         canvas.setFont(serif_font,8)
         canvas.line(footer_margin_hor, footer_margin_vert, page_width - footer_margin_hor, footer_margin_vert )
         if pdfstyles.show_page_footer:
-            p = Paragraph(formatter.cleanText(pagefooter, escape=False), text_style())
+            p = Paragraph(getFormatter().cleanText(pagefooter, escape=False), text_style())
             p.canv = canvas
             w,h = p.wrap(page_width - header_margin_hor*2.5, page_height)
             p.drawOn(canvas, footer_margin_hor, footer_margin_vert - 10 - h)
@@ -120,8 +128,7 @@ class TitlePage(PageTemplate):
         self.cover = cover
 
     def _scale_img(self, img_area_size, img_fn):
-        img = Image.open(self.cover)
-        img_width, img_height = img.size
+        img_width, img_height = image_info.info(img_fn).size
         img_area_width = min(page_width,img_area_size[0])
         img_area_height = min(page_height, img_area_size[1])
         img_ar = img_width/img_height
@@ -139,7 +146,7 @@ class TitlePage(PageTemplate):
             footertext = [_(titlepagefooter)]
             if pdfstyles.show_creation_date:
                 footertext.append('PDF generated at: %s' % strftime("%a, %d %b %Y %H:%M:%S %Z", gmtime()))
-            p = Paragraph('<br/>'.join([formatter.cleanText(line, escape=False) for line in footertext]),
+            p = Paragraph('<br/>'.join([getFormatter().cleanText(line, escape=False) for line in footertext]),
                           text_style(mode='footer'))
             w,h = p.wrap(print_width, print_height)
             canvas.translate( (page_width-w)/2.0, 0.2*cm)
@@ -161,6 +168,29 @@ class TitlePage(PageTemplate):
 from reportlab.platypus.doctemplate import BaseDocTemplate
 from reportlab.pdfgen import canvas
 
+
+def outlineEntries(bookmarks):
+    """Yield (title, key, level, closed) for every bookmark in the list
+    of (title, type, key) tuples"""
+    type2lvl = {'chapter': 0,
+                'article': 1,
+                'heading2': 2,
+                'heading3': 3,
+                'heading4': 4,
+                }
+    got_chapter = False
+    last_lvl =  0
+    for (bm_title, bm_type, bm_key) in bookmarks:
+        lvl = type2lvl[bm_type]
+        if bm_type== 'chapter':
+            got_chapter = True
+        elif not got_chapter: # outline-lvls can't start above zero
+            lvl -= 1
+        lvl = min(lvl, last_lvl + 1)
+        last_lvl = lvl
+        yield (bm_title, bm_key, lvl, bm_type == 'article')
+
+
 class PPDocTemplate(BaseDocTemplate):
 
     def __init__(self, output, status_callback=None, tocCallback=None, **kwargs):
@@ -174,6 +204,10 @@ class PPDocTemplate(BaseDocTemplate):
         self.tocCallback=tocCallback
         self.title = kwargs['title']
 
+    def build(self, flowables, filename=None, canvasmaker=canvas.Canvas):
+        # reportlab needs random access to the flowables
+        BaseDocTemplate.build(self, list(flowables), filename=filename, canvasmaker=canvasmaker)
+
     def progressCB(self, typ, value):
         if typ == 'SIZE_EST':
             self.estimatedDuration = int(value)
@@ -189,23 +223,8 @@ class PPDocTemplate(BaseDocTemplate):
     def _startBuild(self, filename=None, canvasmaker=canvas.Canvas):
         BaseDocTemplate._startBuild(self, filename=filename, canvasmaker=canvasmaker)
 
-        type2lvl = {'chapter': 0,
-                    'article': 1,
-                    'heading2': 2,
-                    'heading3': 3,
-                    'heading4': 4,
-                    }
-        got_chapter = False
-        last_lvl =  0
-        for (bm_id, (bm_title, bm_type)) in enumerate(self.bookmarks):
-            lvl = type2lvl[bm_type]
-            if bm_type== 'chapter':
-                got_chapter = True
-            elif not got_chapter: # outline-lvls can't start above zero
-                lvl -= 1
-            lvl = min(lvl, last_lvl + 1)
-            last_lvl = lvl
-            self.canv.addOutlineEntry(bm_title, str(bm_id), lvl, bm_type == 'article')
+        for (bm_title, bm_key, lvl, closed) in outlineEntries(self.bookmarks):
+            self.canv.addOutlineEntry(bm_title, bm_key, lvl, closed)
 
     def afterFlowable(self, flowable):
         """Our rule for the table of contents is simply to take
@@ -114,6 +114,7 @@ img_default_thumb_width = 180
 img_max_thumb_width = 0.6 # fraction of print width for floated images
 img_max_thumb_height = 0.45
 img_min_res = 75
+img_print_dpi = 200 # images with more pixels than needed for this resolution at their print size are downsampled. 0 keeps all pixels
 img_inline_scale_factor = 0.7 # factor by which inline images are scaled.
 print_width_px = 540 # 540px are assumed to be the equivalent for a full print width
 
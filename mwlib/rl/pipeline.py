@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Staged processing of the items of a book.
+
+Every stage runs in its own thread and hands its results to the next
+stage through a bounded queue. A slow consumer therefore blocks the
+producing stages instead of letting finished work pile up in memory.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import itertools
+import Queue
+import cPickle
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+_done = object()
+
+
+class Stage(object):
+    """Apply func to every object of source in a background thread.
+
+    Iterating over the stage yields the results in the order of source.
+    Exceptions raised by func or by source are re-raised in the consuming
+    thread.
+    """
+
+    def __init__(self, func, source, maxsize=2, name=None):
+        self.func = func
+        self.source = source
+        self.queue = Queue.Queue(max(1, maxsize))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, entry):
+        while not self.stopped.isSet():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            try:
+                for obj in self.source:
+                    if not self._put((self.func(obj), None)):
+                        return
+            except Exception:
+                self._put((None, sys.exc_info()))
+                return
+            self._put((_done, None))
+        finally:
+            # e.g. terminates the thread pool of a prefetch() generator
+            close = getattr(self.source, 'close', None)
+            if close is not None and not isinstance(self.source, Stage):
+                close()
+
+    def stop(self):
+        """Make the stage (and all stages feeding it) give up their work."""
+        self.stopped.set()
+        if isinstance(self.source, Stage):
+            self.source.stop()
+
+    def close(self):
+        """Stop the stage and all stages feeding it and wait for their
+        threads to exit. Results which were not consumed are dropped."""
+        self.stop()
+        self.thread.join()
+        if isinstance(self.source, Stage):
+            self.source.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                res, exc_info = self.queue.get()
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if res is _done:
+                    return
+                yield res
+        finally:
+            self.stop()
+
+
+def pipeline(source, funcs, maxsize=2):
+    """Chain one Stage per function in funcs, starting with source.
+
+    @rtype: Stage
+    """
+    stage = source
+    for func in funcs:
+        stage = Stage(func, stage, maxsize=maxsize, name=getattr(func, '__name__', None))
+    return stage
+
+
+def prefetch(func, source, threads=4, window=None):
+    """Apply func to the objects of source in a pool of threads and
+    yield the results in the order of source.
+
+    At most window (defaults to twice the number of threads) objects
+    are in flight at any time, so only the upcoming objects are
+    prefetched.
+    """
+    if threads <= 1:
+        for obj in source:
+            yield func(obj)
+        return
+    window = window or 2 * threads
+    source = iter(source)
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for obj in itertools.islice(source, window):
+            pending.append(pool.apply_async(func, (obj,)))
+        while pending:
+            result = pending.popleft()
+            for obj in itertools.islice(source, 1):
+                pending.append(pool.apply_async(func, (obj,)))
+            yield result.get()
+    finally:
+        pool.terminate()
+
+
+class ElementSpool(object):
+    """Append-only on-disk store for the laid out segments of a book.
+
+    Every segment is pickled to a temporary file as soon as it is
+    appended. This allows to render parts of the book again (or a
+    second time) without keeping all elements in memory and without
+    laying them out again.
+    """
+
+    def __init__(self, dirname=None):
+        fd, self.path = tempfile.mkstemp(suffix='.spool', dir=dirname)
+        self.f = os.fdopen(fd, 'w+b')
+        self.offsets = []
+        self.sizes = [] # pickled size of the segments, a rough estimate of their rendering cost
+        self.info = []
+
+    def _dump(self, elements):
+        self.f.seek(0, 2)
+        offset = self.f.tell()
+        cPickle.dump(elements, self.f, cPickle.HIGHEST_PROTOCOL)
+        return offset, self.f.tell() - offset
+
+    def append(self, info, elements):
+        """Store elements together with some info about the segment.
+
+        @returns: index of the segment
+        """
+        offset, size = self._dump(elements)
+        self.offsets.append(offset)
+        self.sizes.append(size)
+        self.info.append(info)
+        return len(self.offsets) - 1
+
+    def replace(self, idx, elements):
+        self.offsets[idx], self.sizes[idx] = self._dump(elements)
+
+    def reopen(self):
+        """Use a file object of its own, e.g. after the process was forked.
+        The file position is shared with the parent otherwise."""
+        self.f = open(self.path, 'rb')
+
+    def __getitem__(self, idx):
+        self.f.seek(self.offsets[idx])
+        return cPickle.load(self.f)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.f.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Local render server which keeps fonts, license tables, lexers and
+translations resident between jobs.
+
+Start the server with::
+
+    python -m mwlib.rl.renderserver --socket /tmp/mwlib.rl.sock
+
+and send jobs with render() or from the command line::
+
+    python -m mwlib.rl.renderserver --socket /tmp/mwlib.rl.sock --render collection.zip output.pdf
+
+A job is one line of JSON::
+
+    {"config": "collection.zip", "output": "output.pdf", "status_file": null, "options": {"lang": "de"}}
+
+options are the options of the rl writer. Every job is rendered in a
+child forked from the warm server, so state which the writer changes
+globally (pdfstyles, the installed translation, ...) does not leak into
+later jobs. The reply is one line of JSON as well: {"status": "ok"} or
+{"status": "error", "error": "..."}
+"""
+
+import os
+import sys
+import errno
+import gettext
+import socket
+import traceback
+import optparse
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mwlib import log
+
+log = log.Log('renderserver')
+
+# source languages whose lexers are loaded in advance
+preload_lexers = ['python', 'c', 'cpp', 'java', 'javascript', 'php', 'perl', 'ruby',
+                  'bash', 'sql', 'xml', 'html', 'css', 'lisp', 'haskell', 'csharp']
+
+
+def warmUp():
+    """Import and initialize everything which is shared between jobs."""
+    from mwlib.rl import rlwriter, pagetemplates
+    # registers the fonts and reads the license table
+    rlwriter.RlWriter().cleanup()
+    pagetemplates.getFormatter()
+    for name in preload_lexers:
+        rlwriter.getLexer(name)
+    # gettext keeps the parsed catalogs
+    localedir = os.path.join(os.path.dirname(os.path.abspath(rlwriter.__file__)), 'locale')
+    if os.path.isdir(localedir):
+        for lang in os.listdir(localedir):
+            try:
+                gettext.translation('mwlib.rl', localedir, [lang])
+            except IOError:
+                pass
+
+
+def renderJob(job):
+    from mwlib import wiki
+    from mwlib.status import Status
+    from mwlib.rl import rlwriter
+
+    env = wiki.makewiki(job['config'])
+    status = Status(filename=job.get('status_file'))
+    options = dict((str(k), v) for (k, v) in (job.get('options') or {}).items())
+    rlwriter.writer(env, job['output'], status_callback=status, **options)
+
+
+def _readLine(conn):
+    data = []
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data.append(chunk)
+        if '\n' in chunk:
+            break
+    return ''.join(data).split('\n', 1)[0]
+
+
+def handleConnection(conn):
+    """Render the job sent over conn and reply. Runs in the forked child."""
+    try:
+        job = json.loads(_readLine(conn))
+        renderJob(job)
+        reply = {'status': 'ok'}
+    except Exception, err:
+        traceback.print_exc()
+        reply = {'status': 'error', 'error': '%s: %s' % (err.__class__.__name__, err)}
+    conn.sendall(json.dumps(reply) + '\n')
+
+
+class RenderServer(object):
+
+    def __init__(self, socket_path, max_jobs=4):
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+        self.children = set()
+
+    def _reap(self, block=False):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno == errno.ECHILD:
+                    self.children.clear()
+                break
+            if pid == 0:
+                break
+            self.children.discard(pid)
+            block = False
+
+    def serve(self):
+        warmUp()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(16)
+        log.info('listening on %r' % self.socket_path)
+        try:
+            while True:
+                self._reap()
+                if len(self.children) >= self.max_jobs:
+                    self._reap(block=True)
+                    continue
+                try:
+                    conn, addr = sock.accept()
+                except socket.error, err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                pid = os.fork()
+                if pid == 0:
+                    sock.close()
+                    code = 0
+                    try:
+                        handleConnection(conn)
+                    except:
+                        traceback.print_exc()
+                        code = 1
+                    conn.close()
+                    os._exit(code)
+                conn.close()
+                self.children.add(pid)
+        finally:
+            sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def render(socket_path, config, output, status_file=None, **options):
+    """Let the server listening on socket_path render a book.
+
+    @returns: reply of the server, a dict
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        job = {'config': config,
+               'output': os.path.abspath(output),
+               'status_file': status_file,
+               'options': options,
+               }
+        sock.sendall(json.dumps(job) + '\n')
+        return json.loads(_readLine(sock))
+    finally:
+        sock.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog --socket PATH [--render CONFIG OUTPUT]')
+    parser.add_option('-s', '--socket', help='path of the UNIX socket')
+    parser.add_option('-j', '--max-jobs', type='int', default=4,
+                      help='number of jobs rendered at the same time (default 4)')
+    parser.add_option('--render', action='store_true',
+                      help='send a job to a running server instead of starting one')
+    options, args = parser.parse_args()
+    if not options.socket:
+        parser.error('--socket is required')
+    if options.render:
+        if len(args) != 2:
+            parser.error('--render needs CONFIG and OUTPUT')
+        reply = render(options.socket, args[0], args[1])
+        print json.dumps(reply)
+        sys.exit(0 if reply.get('status') == 'ok' else 1)
+    RenderServer(options.socket, max_jobs=options.max_jobs).serve()
+
+
+if __name__ == '__main__':
+    main()
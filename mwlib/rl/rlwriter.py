@@ -14,9 +14,14 @@ import urllib
 import traceback
 import tempfile
 import shutil
-import subprocess
-import copy
+import time
 import gc
+import types
+import cPickle
+import multiprocessing
+import threading
+import itertools
+from collections import deque
 
 try:
     from hashlib import md5
@@ -24,10 +29,9 @@ except ImportError:
     from md5 import md5
 
 from xml.sax.saxutils import escape as xmlescape
-from PIL import Image as PilImage
-
-from pygments import highlight
-from pygments  import lexers
+# pygments and mwlib.timeline are only imported when a node needs them.
+# PIL is imported anyway: reportlab.lib.utils and mwlib.writer.imageutils
+# import it on module import.
 #from rlsourceformatter import ReportlabFormatter
 
 from mwlib.rl.latexelements import Paragraph, HRFlowable
@@ -57,19 +61,20 @@ from reportlab import rl_config
 #from reportlab.platypus.paragraph import Paragraph
 #from reportlab.platypus.doctemplate import BaseDocTemplate
 
-from pagetemplates import PPDocTemplate
+from pagetemplates import WikiPage, TitlePage, outlineEntries
 
 #from reportlab.platypus.doctemplate import NextPageTemplate, NotAtTopPageBreak
 #from reportlab.platypus.tables import Table
 #from reportlab.platypus.flowables import Spacer, HRFlowable, PageBreak, CondPageBreak
 #from reportlab.platypus.xpreformatted import XPreformatted
-#from reportlab.lib.units import cm
-#from reportlab.lib import colors
-#from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_RIGHT, TA_LEFT
+from reportlab.lib.units import cm
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_RIGHT
 
 #from mwlib.rl.customflowables import Figure, FiguresAndParagraphs, SmartKeepTogether, TocEntry, DummyTable
 from mwlib.rl.latexelements import Figure, FiguresAndParagraphs, SmartKeepTogether, TocEntry, DummyTable, ListItem
-from mwlib.rl.latextemplate import NextPageTemplate
+from mwlib.rl.latexelements import Spacer, PageBreak, CondPageBreak, NotAtTopPageBreak, XPreformatted
+from mwlib.rl.latextemplate import BaseDocTemplate, NextPageTemplate
 
 
 from pdfstyles import text_style, heading_style, table_style
@@ -80,15 +85,22 @@ import pdfstyles
 from mwlib.writer.imageutils import ImageUtils
 from mwlib.writer import miscutils, styleutils
 
-import rltables
 #from pagetemplates import WikiPage, TitlePage
 
-from mwlib import parser, log, uparser,  timeline
+from mwlib import parser, log, uparser
 from mwlib.dummydb import DummyDB
 from mwlib.writer.licensechecker import LicenseChecker
 from mwlib.rl import fontconfig
-from mwlib.rl.customnodetransformer import CustomNodeTransformer
+from mwlib.rl.customnodetransformer import CustomNodeTransformer, css_map
 from mwlib.rl.formatter import RLFormatter
+from mwlib.rl.pipeline import pipeline, prefetch, ElementSpool
+from mwlib.rl.diskcache import DiskCache
+from mwlib.rl import shards
+from mwlib.rl.nodetimer import NodeTimer
+from mwlib.rl.lrucache import LRUCache
+from mwlib.rl import imageprep
+from mwlib.rl.imageinfo import image_info
+from mwlib.rl.wrapcache import wrap_cache
 
 log = log.Log('rlwriter')
 
@@ -114,9 +126,18 @@ def flatten(x):
     return result
 
 
+class InlineRun(list):
+    """Result of a write method which only contains inline markup, i.e.
+    strings. isInline doesn't need to look at the elements of a run."""
+
+
 def isInline(objs):
-    for obj in flatten(objs):
-        if not (isinstance(obj, unicode) or isinstance(obj, str)):
+    if objs.__class__ is InlineRun:
+        return True
+    for obj in objs:
+        if isinstance(obj, basestring):
+            continue
+        if not hasattr(obj, "__iter__") or not isInline(obj):
             return False
     return True
 
@@ -141,6 +162,124 @@ def buildPara(txtList, style=text_style(), txt_style=None):
         return []
 
 
+def wrappedHeight(flowable, width, height):
+    """Height of flowable wrapped to width x height, 0 if it can't be
+    wrapped. The size is taken from the wrap cache if possible."""
+    if not hasattr(flowable, 'wrap'): # most LaTeX elements
+        return 0
+    try:
+        w, h = wrap_cache.size(flowable, width, height)
+    except:
+        h = 0
+    return h
+
+
+class ArticleLayout(object):
+    """Laid out article together with the side tables that are
+    collected while writing it. Used to ship the result of a layout
+    worker back to the process which builds the document.
+    """
+
+    def __init__(self, caption, elements, bookmarks, img_meta_info, article_meta_info, bookmark_ns=''):
+        self.caption = caption
+        self.elements = elements
+        self.bookmarks = bookmarks
+        self.img_meta_info = img_meta_info
+        self.article_meta_info = article_meta_info
+        self.bookmark_ns = bookmark_ns
+        self.page_templates = [] # (title, rtl) of the WikiPages the elements refer to
+        self.timing = None # NodeTimer of the layout, if timing is enabled
+        # dependencies of a cached layout on the book it was laid out for:
+        # image tuples, see RlWriter.addImageDep, and article id -> link was internal
+        self.image_deps = []
+        self.link_deps = {}
+
+    # part of the render cache keys, change it whenever the dependencies change
+    version = 2
+
+
+def _configRepr(value):
+    """Return a stable representation of a configuration value or None
+    if the value has no such representation."""
+    if isinstance(value, (type, types.ClassType)):
+        value = value.__dict__.get('__init__')
+    code = getattr(value, 'func_code', None)
+    if code is not None:
+        return repr((code.co_code,
+                     code.co_names,
+                     [c for c in code.co_consts if not isinstance(c, types.CodeType)]))
+    if isinstance(value, types.ModuleType):
+        return None
+    r = repr(value)
+    if ' at 0x' in r:
+        return None
+    return r
+
+
+# writer and metabook items shared with forked layout workers
+_pool_writer = None
+_pool_items = None
+
+def _initLayoutWorker():
+    # status callbacks must only be called from the parent process
+    _pool_writer.layout_status = None
+    _pool_writer.render_status = None
+
+def _renderShardInWorker(job):
+    return _pool_writer.renderShard(*job)
+
+def _layoutArticleInWorker(job):
+    idx, has_preceeding_chapter, occurrence = job
+    return _pool_writer.layoutArticleIsolated(_pool_items[idx],
+                                              has_preceeding_chapter=has_preceeding_chapter,
+                                              bookmark_ns='a%d.' % idx,
+                                              occurrence=occurrence)
+
+
+# titles containing none of these are plain text and rendered without the parser
+_title_markup_re = re.compile(r"[\[\]{}<>'&|=~_*#:;!\n]|^\s|\s$|^----|ISBN|RFC|PMID")
+
+# node classes which never carry style or direction attributes. they are written
+# without asking the formatter and without checking the text direction
+plain_node_classes = set([advtree.Text])
+
+# lexers by source language. loading a lexer imports its module, so lexers are kept
+_lexers = {}
+
+def getLexer(name):
+    if name in _lexers:
+        return _lexers[name]
+    from pygments import lexers
+    langMap = {'lisp': lexers.CommonLispLexer} #custom Mapping between mw-markup source attrs to pygement lexers if get_lexer_by_name fails
+    try:
+        lexer = lexers.get_lexer_by_name(name)
+    except lexers.ClassNotFound:
+        lexer_class = langMap.get(name)
+        if lexer_class:
+            lexer = lexer_class()
+        else:
+            traceback.print_exc()
+            log.error('unknown source code language: %s' % repr(name))
+            lexer = None
+    _lexers[name] = lexer
+    return lexer
+
+# license checkers with the parsed license table, by filter type
+_license_checkers = {}
+
+def _makeLicenseChecker(image_db, filter_type):
+    """Return a new LicenseChecker. The license table is only read once
+    per process and shared by all checkers."""
+    proto = _license_checkers.get(filter_type)
+    if proto is None:
+        proto = LicenseChecker(filter_type=filter_type)
+        proto.readLicensesCSV()
+        _license_checkers[filter_type] = proto
+    checker = LicenseChecker(image_db=image_db, filter_type=filter_type)
+    checker.licenses = proto.licenses
+    return checker
+
+
 class ReportlabError(Exception):
 
     def __init__(self, value):
@@ -152,7 +291,9 @@ class ReportlabError(Exception):
 
 class RlWriter(object):
 
-    def __init__(self, env=None, strict=False, debug=False, mathcache=None, lang=None, test_mode=False):
+    def __init__(self, env=None, strict=False, debug=False, mathcache=None, lang=None, test_mode=False, workers=1,
+                 rendercache=None, rendercache_size=1024, prefetch_threads=4, shards=1, timing=None,
+                 image_workers=4, imagecache=None, imagecache_size=1024):
         localedir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'locale')
         translation = gettext.NullTranslations()
         if lang:
@@ -182,6 +323,8 @@ class RlWriter(object):
                 pdfstyles.serif_font = arabic_font
                 pdfstyles.sans_font = arabic_font
             rl_config.rtl = True
+        # direction every article starts in. self.rtl changes while nodes are written
+        self.base_rtl = self.rtl
 
         self.env = env
         if self.env is not None:
@@ -193,16 +336,18 @@ class RlWriter(object):
         self.strict = strict
         self.debug = debug
         self.test_mode = test_mode
+        self.lang = lang
+        self.workers = max(1, workers or 1)
+        self.pipeline_depth = 2 # number of articles buffered between two stages of the layout pipeline
 
         try:
             strict_server = self.env.wiki.siteinfo['general']['server'] in [u'http://de.wikipedia.org']
         except:
             strict_server = False
         if strict_server:
-            self.license_checker = LicenseChecker(image_db=self.imgDB, filter_type='whitelist')
+            self.license_checker = _makeLicenseChecker(self.imgDB, 'whitelist')
         else:
-            self.license_checker = LicenseChecker(image_db=self.imgDB, filter_type='blacklist')
-        self.license_checker.readLicensesCSV()
+            self.license_checker = _makeLicenseChecker(self.imgDB, 'blacklist')
 
         self.img_meta_info = {}
         self.img_count = 0
@@ -212,9 +357,7 @@ class RlWriter(object):
         self.font_switcher.registerFontDefinitionList(fontconfig.fonts)
         self.font_switcher.registerReportlabFonts(fontconfig.fonts)
 
-        self.tc = TreeCleaner([], save_reports=self.debug, rtl=self.rtl)
-        self.tc.skipMethods = pdfstyles.treecleaner_skip_methods
-        self.tc.contentWithoutTextClasses.append(advtree.ReferenceList)
+        self.tc = self.makeTreeCleaner()
 
         self.cnt = CustomNodeTransformer()
         self.formatter = RLFormatter(font_switcher=self.font_switcher)
@@ -231,6 +374,9 @@ class RlWriter(object):
 
         self.references = []
         self.ref_name_map = {}
+        # render state of tree nodes, the tree itself is not modified while writing
+        self.ref_nums = {} # id of reference node -> reference number
+        self.lstrip_leaves = set() # ids of text nodes written without leading whitespace
         self.listIndentation = 0  # nesting level of lists
         self.listCounterID = 1
         self.tmpImages = set()
@@ -248,22 +394,60 @@ class RlWriter(object):
         self.linkList = []
         self.disable_group_elements = False
         self.fail_safe_rendering = False
+        self.spool = None
 
         self.sourceCount = 0
         self.currentColCount = 0
         self.math_cache_dir = mathcache or os.environ.get('MWLIBRL_MATHCACHE')
         self.tmpdir = tempfile.mkdtemp()
         self.bookmarks = []
+        self.bookmark_ns = ''
         self.colwidth = 0
 
-        self.articleids = []
+        self.articleids = set()
+        self._article_id_cache = {} # (wikiurl, title) -> article id
+        self.article_wikiurl = '' # wikiurl of the article being written
         self.layout_status = None
         self.toc_entries = []
         self.toc_renderer = TocRenderer()
         self.reference_list_rendered = False
         self.article_meta_info = []
         self.url_map = {}
-        self.fixed_images = {}
+        self.fixed_images = {} # utf-8 encoded image path -> path of the repaired image, '' if it can't be used
+        self.converted_svgs = {} # svg path -> png path, '' if the conversion failed
+        self.resampled_images = {} # (image path, print width, print height) -> path of the downsampled image
+        self.image_digests = {} # image path -> content digest, see imageDigest
+        self.image_workers = image_workers
+        self.image_pool = None # pool of image_workers processes preparing the images of upcoming articles
+        self.image_lock = threading.Lock()
+        self.wiki_lock = threading.Lock() # serializes the wiki access of the prefetch threads
+        self.submitted_images = set() # disk paths of the images handed to image_pool
+        imagecache = imagecache or os.environ.get('MWLIBRL_IMAGECACHE')
+        if imagecache:
+            self.image_cache = DiskCache(imagecache, max_size=imagecache_size*1024*1024, suffix='.img')
+        else:
+            self.image_cache = None
+
+        rendercache = rendercache or os.environ.get('MWLIBRL_RENDERCACHE')
+        if rendercache:
+            self.render_cache = DiskCache(rendercache, max_size=rendercache_size*1024*1024, suffix='.layout')
+        else:
+            self.render_cache = None
+        self._style_digest = None
+        self.prefetch_threads = prefetch_threads
+        self.shards = shards
+        # filename of the JSON timing report. timing is only recorded if set
+        self.timing_report = timing or os.environ.get('MWLIBRL_TIMING')
+        self.node_timer = NodeTimer() if self.timing_report else None
+        self._handlers = {} # node class -> (write function, is plain node class)
+        self.title_cache = LRUCache(max_entries=1024) # (title, rtl) -> rendered title
+        self.spool_complete = False
+        self.spool_failed = False
+        self.page_templates = None
+        self.item_articleids = {}
+        self.source_cache = {}
+        self.image_deps = None
+        self.link_deps = None
 
 
     def ignore(self, obj):
@@ -282,33 +466,39 @@ class RlWriter(object):
         def isHeading(e):
             return isinstance(e, HRFlowable) or (hasattr(e, 'style') and e.style.name.startswith('heading_style'))
         groupHeight = 0
-        while elements:
+        i = 0
+        num_elements = len(elements)
+        while i < num_elements:
+            element = elements[i]
             if not group:
-                if isHeading(elements[0]):
-                    group.append(elements.pop(0))
+                if isHeading(element):
+                    group.append(element)
                 else:
-                    groupedElements.append(elements.pop(0))
+                    groupedElements.append(element)
+                i += 1
             else:
                 last = group[-1]
                 if not isHeading(last):
-                    try:
-                        w, h = last.wrap(print_width, print_height)
-                    except:
-                        h = 0
-                    groupHeight += h
-                    if groupHeight > print_height / 10 or isinstance(elements[0], NotAtTopPageBreak): # 10 % of page_height
+                    groupHeight += wrappedHeight(last, print_width, print_height)
+                    if groupHeight > print_height / 10 or isinstance(element, NotAtTopPageBreak): # 10 % of page_height
                         groupedElements.append(SmartKeepTogether(group))
                         group = []
                         groupHeight = 0
-                    else:
-                        group.append(elements.pop(0))
-                else:
-                    group.append(elements.pop(0))
+                        continue
+                group.append(element)
+                i += 1
         if group:
             groupedElements.append(SmartKeepTogether(group))
 
         return groupedElements
 
+    def addBookmark(self, title, bm_type):
+        """Register an outline entry and return the anchor markup
+        which marks its position in the text."""
+        key = '%s%d' % (self.bookmark_ns, len(self.bookmarks))
+        self.bookmarks.append((title, bm_type, key))
+        return '<a name="%s"/>' % key
+
     def check_direction(self, node):
         original = self.rtl
         try:
@@ -330,21 +520,48 @@ class RlWriter(object):
         else:
             pdfstyles.word_wrap = self.word_wrap
 
+    def _getHandler(self, node_class):
+        """Look up the write method for node_class and add it to the
+        dispatch table. Returns a tuple (function or None, is plain node class)"""
+        func = getattr(self.__class__, 'write' + node_class.__name__, None)
+        if func is not None:
+            func = func.im_func
+        entry = self._handlers[node_class] = (func, node_class in plain_node_classes)
+        return entry
+
     def write(self, obj):
-        m = "write" + obj.__class__.__name__
-        if not hasattr(self, m):
+        try:
+            func, plain = self._handlers[obj.__class__]
+        except KeyError:
+            func, plain = self._getHandler(obj.__class__)
+        if func is None:
             log.error('unknown node:', repr(obj.__class__.__name__))
             if self.strict:
                 raise writerbase.WriterError('Unkown Node: %s ' % obj.__class__.__name__)
             return []
-        m=getattr(self, m)
+        if self.node_timer is not None:
+            return self._timedWrite(func, obj)
+        if plain:
+            return func(self, obj)
         styles = self.formatter.setStyle(obj)
         original = self.check_direction(obj)
-        res = m(obj)
+        res = func(self, obj)
         self.set_rtl(original)
         self.formatter.resetStyle(styles)
         return res
 
+    def _timedWrite(self, func, obj):
+        self.node_timer.enter('write' + obj.__class__.__name__)
+        try:
+            styles = self.formatter.setStyle(obj)
+            original = self.check_direction(obj)
+            res = func(self, obj)
+            self.set_rtl(original)
+            self.formatter.resetStyle(styles)
+            return res
+        finally:
+            self.node_timer.leave()
+
     def getVersion(self):
         try:
             extversion = _('mwlib.ext version: %(version)s') % {
@@ -360,65 +577,121 @@ class RlWriter(object):
         }
         return version
 
+    def makeTreeCleaner(self):
+        tc = TreeCleaner([], save_reports=self.debug, rtl=self.rtl)
+        tc.skipMethods = pdfstyles.treecleaner_skip_methods
+        tc.contentWithoutTextClasses.append(advtree.ReferenceList)
+        return tc
+
     def buildArticle(self, item):
+        art = self.fetchArticle(item)
+        self.fetchAuthors(item, art)
+        return self.prepareArticle(art)
+
+    def fetchArticle(self, item):
+        """Fetch and parse the article of a metabook item and attach
+        the meta data needed for rendering, except for the authors.
+
+        This is called from the prefetch threads. The wiki is not
+        assumed to be thread-safe, the calls are serialized by wiki_lock.
+        """
         mywiki = item.wiki
-        art = mywiki.getParsedArticle(title=item.title,
-                                             revision=item.revision)
-        if not art:
-            return # FIXME
+        self.wiki_lock.acquire()
         try:
-            ns = item.wiki.normalize_and_get_page(item.title,0).ns
-        except AttributeError:
-            ns = 0
+            art = mywiki.getParsedArticle(title=item.title,
+                                          revision=item.revision)
+            if not art:
+                return # FIXME
+            try:
+                ns = item.wiki.normalize_and_get_page(item.title,0).ns
+            except AttributeError:
+                ns = 0
+            art.url = mywiki.getURL(item.title, item.revision) or None
+        finally:
+            self.wiki_lock.release()
         art.ns = ns
-        art.url = mywiki.getURL(item.title, item.revision) or None
         if item.displaytitle is not None:
             art.caption = item.displaytitle
-        source = mywiki.getSource(item.title, item.revision)
+        source = self.getSource(item)
         if source:
             art.wikiurl = source.url or ""
         else:
             art.wikiurl = None
-        art.authors = mywiki.getAuthors(item.title, revision=item.revision)
-        advtree.buildAdvancedTree(art)
+        return art
+
+    def fetchAuthors(self, item, art):
+        """Attach the authors of the article. This has to be called from
+        the main thread: the nuwiki adapter looks them up in an sqlite
+        database, which can only be used by the thread that opened it."""
+        if art:
+            art.authors = item.wiki.getAuthors(item.title, revision=item.revision)
+
+    def prepareArticle(self, art, tc=None):
+        """Build the advanced tree of a parsed article, clean it with tc
+        (defaults to self.tc) and apply the custom css styles.
+
+        A TreeCleaner must not be shared between threads, the prepare
+        stage of the article pipeline brings its own.
+
+        If timing is enabled the time of every pass (tree building, each
+        cleaner method, css mapping) is stored in art.pass_timing and
+        added to the timer when the article is laid out.
+        """
+        if not art:
+            return art
+        passes = [] if self.node_timer is not None else None
+        self._timePass(passes, 'buildAdvancedTree', advtree.buildAdvancedTree, art)
         if self.debug:
             parser.show(sys.stdout, art)
             pass
-        self.tc.tree = art
-        self.tc.cleanAll()
-        self.cnt.transformCSS(art)
+        tc = tc or self.tc
+        tc.tree = art
+        cleaner_methods = getattr(tc, 'cleanerMethods', None)
+        if passes is None or cleaner_methods is None:
+            tc.cleanAll()
+        else:
+            for method in cleaner_methods:
+                if method not in tc.skipMethods:
+                    self._timePass(passes, 'clean.' + method, tc.clean, [method])
+        self._timePass(passes, 'transformCSS', self.cnt.transformCSS, art)
+        art.pass_timing = passes
         if self.debug:
             #parser.show(sys.stdout, art)
-            print "\n".join([repr(r) for r in self.tc.getReports()])
+            print "\n".join([repr(r) for r in tc.getReports()])
         return art
 
 
+    def _timePass(self, passes, name, func, *args):
+        if passes is None:
+            return func(*args)
+        stime = time.time()
+        res = func(*args)
+        passes.append((name, time.time() - stime))
+        return res
+
     def initReportlabDoc(self, output):
         version = self.getVersion()
         if pdfstyles.render_toc:
             tocCallback = self.tocCallback
         else:
             tocCallback = None
-        self.doc = PPDocTemplate(output,
-                                 topMargin=pdfstyles.page_margin_top,
-                                 leftMargin=pdfstyles.page_margin_left,
-                                 rightMargin=pdfstyles.page_margin_right,
-                                 bottomMargin=pdfstyles.page_margin_bottom,
-                                 title=self.book.title,
-                                 keywords=version,
-                                 status_callback=self.render_status,
-                                 tocCallback=tocCallback,
+        # the elements are LaTeX substitutes of the reportlab flowables,
+        # so the book is built with the LaTeX document template
+        self.doc = BaseDocTemplate(output,
+                                   topMargin=pdfstyles.page_margin_top,
+                                   leftMargin=pdfstyles.page_margin_left,
+                                   rightMargin=pdfstyles.page_margin_right,
+                                   bottomMargin=pdfstyles.page_margin_bottom,
+                                   title=self.book.title,
+                                   keywords=version,
+                                   status_callback=self.render_status,
+                                   tocCallback=tocCallback,
         )
+        self.doc.bookmarks = []
 
 
     def articleRenderingOK(self, node, output):
-        testdoc = BaseDocTemplate(output,
-                                  topMargin=pdfstyles.page_margin_top,
-                                  leftMargin=pdfstyles.page_margin_left,
-                                  rightMargin=pdfstyles.page_margin_right,
-                                  bottomMargin=pdfstyles.page_margin_bottom,
-                                  title='',
-                                  )
+        testdoc = self._testDoc()
         # PageTemplates are registered to self.doc in writeArticle
         doc_bak, self.doc = self.doc, testdoc
         elements = self.writeArticle(node)
@@ -452,9 +725,122 @@ class RlWriter(object):
             self.layout_status = None
             self.render_status = None
         self.initReportlabDoc(output)
+        if not self.fail_safe_rendering:
+            self.spool = ElementSpool(self.tmpdir)
+            self.spool_complete = False
+            self.spool_failed = False
 
-        elements = []
+        elements = self.iterBookElements(output, coverimage=coverimage)
+        try:
+            if self.useShards():
+                self.renderBookSharded(elements, output)
+            else:
+                self.renderBook(elements, output, coverimage=coverimage)
+            log.info('RENDERING OK')
+            self.cleanup()
+            return
+        except MemoryError:
+            elements.close()
+            self.cleanup()
+            raise
+        except Exception, err:
+            traceback.print_exc()
+            log.error('RENDERING FAILED: %r' % err)
+        if self.fail_safe_rendering:
+            elements.close()
+            log.error('GIVING UP')
+            self.cleanup()
+            raise RuntimeError('Giving up.')
+
+        self.fail_safe_rendering = True
+        if self.spool is not None:
+            try:
+                for e in elements: # the backend might have failed before all articles were laid out
+                    pass
+            except Exception, err:
+                traceback.print_exc()
+                log.error('laying out the remaining articles failed: %r' % err)
+                self.closeSpool()
+            if not self.spool_complete: # layout failed, not all articles are in the spool
+                self.closeSpool()
+        if self.spool is None:
+            # nothing to reuse: lay out the whole book again and check every article
+            elements.close()
+            self.writeBook(output, coverimage=coverimage, status_callback=status_callback)
+            return
+
+        try:
+            self.renderBook(self.iterRecoveredElements(), output, coverimage=coverimage)
+            log.info('RENDERING OK')
+        except MemoryError:
+            raise
+        except Exception, err:
+            traceback.print_exc()
+            log.error('RENDERING FAILED: %r' % err)
+            log.error('GIVING UP')
+            raise RuntimeError('Giving up.')
+        finally:
+            self.cleanup()
+
+    def closeSpool(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def cleanup(self):
+        self.closeSpool()
+        if self.image_pool is not None:
+            self.image_pool.terminate()
+            self.image_pool = None
+        self.writeTimingReport()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def writeTimingReport(self):
+        if self.node_timer is None:
+            return
+        log.info('layout timing:\n%s' % self.node_timer.summary())
+        log.info('image info cache of this process: %(hits)d hits, %(misses)d misses, hit rate %(hit_rate).2f' % image_info.stats())
+        log.info('wrap cache of this process: %(hits)d hits, %(misses)d misses, hit rate %(hit_rate).2f' % wrap_cache.stats())
+        try:
+            self.node_timer.dump(self.timing_report)
+        except IOError, err:
+            log.warning('could not write timing report: %r' % err)
+
+    def iterBookElements(self, output, coverimage=None):
+        """Lay out the book and yield its elements article by article,
+        so that finished articles can be passed on to the document
+        backend while the next ones are still being laid out.
+
+        Every segment is stored in the spool (if present) before it is
+        handed on, so that it can be reused if rendering fails. If a
+        segment can't be stored, spool_failed is set and the following
+        segments are only handed on. The spool keeps the segments stored
+        before.
+
+        Spooling is not conditional: once the backend consumed a segment
+        it can only be recovered from the spool. The time and disk space
+        it takes are reported in the spool and spool_kb columns of
+        benchmarks/bench_books.py.
+        """
+        for (kind, idx, has_chapter, bookmark_ns, elements) in self.iterBookSegments(output, coverimage=coverimage):
+            if self.spool is not None and not self.spool_failed:
+                try:
+                    self.spool.append((kind, idx, has_chapter, bookmark_ns), elements)
+                except Exception, err:
+                    log.warning('can not spool elements, failed articles can not be isolated: %r' % err)
+                    self.spool_failed = True
+            for e in elements:
+                yield e
+        self.spool_complete = not self.spool_failed
+
+    def iterBookSegments(self, output, coverimage=None):
+        """Lay out the book and yield it in segments: the front matter,
+        chapters and articles. Segments are yielded as tuples
+        (kind, index of the metabook item, preceeded by chapter,
+        namespace of the bookmarks, elements).
+        """
         self.toc_entries = []
+        elements = []
         if pdfstyles.show_title_page:
             elements.extend(self.writeTitlePage(coverimage=coverimage or pdfstyles.title_page_image))
 
@@ -464,64 +850,456 @@ class RlWriter(object):
         item_list = self.env.metabook.walk()
         if not self.fail_safe_rendering:
             elements.append(TocEntry(txt=_('Articles'), lvl='group'))
+        yield ('front', None, False, '', elements)
+
+        if self.workers > 1 and not self.fail_safe_rendering:
+            layouts = self.layoutArticlesInPool(item_list)
+            stage = articles = None
+        else:
+            layouts = None
+            stage = self.articlePipeline(item_list)
+            articles = iter(stage)
+        try:
+            for (i, item) in enumerate(item_list):
+                if item.type == 'chapter':
+                    chapter = parser.Chapter(item.title.strip())
+                    if len(item_list) > i+1 and item_list[i+1].type == 'article':
+                        chapter.next_article_title = item_list[i+1].title
+                    else:
+                        chapter.next_article_title = ''
+                    yield ('chapter', i, False, '', self.writeChapter(chapter))
+                    got_chapter = True
+                elif item.type == 'article' and layouts is not None:
+                    has_chapter, got_chapter = got_chapter, False
+                    layout = layouts.next()
+                    if layout:
+                        yield ('article', i, has_chapter, layout.bookmark_ns, self.mergeArticleLayout(layout))
+                elif item.type == 'article' and not self.fail_safe_rendering:
+                    (job_idx, has_chapter, occurrence), cache_key, art, images = articles.next()
+                    got_chapter = False
+                    self.imgDB = item.images
+                    self.license_checker.image_db = self.imgDB
+                    self.collectArticleImages(images)
+                    if isinstance(art, ArticleLayout):
+                        if self.cachedLayoutValid(art):
+                            layout = art
+                        else:
+                            layout = self.layoutPreparedArticle(item, self.buildArticle(item), has_chapter,
+                                                                cache_key=cache_key)
+                    else:
+                        self.fetchAuthors(item, art)
+                        layout = self.layoutPreparedArticle(item, art, has_chapter,
+                                                            bookmark_ns='a%d.' % i, cache_key=cache_key)
+                    if layout:
+                        yield ('article', i, has_chapter, layout.bookmark_ns, self.mergeArticleLayout(layout))
+                elif item.type == 'article':
+                    job, cache_key, art, images = articles.next()
+                    self.imgDB = item.images
+                    self.license_checker.image_db = self.imgDB
+                    self.collectArticleImages(images)
+                    if not art:
+                        continue
+                    self.fetchAuthors(item, art)
+                    has_chapter = got_chapter
+                    if got_chapter:
+                        art.has_preceeding_chapter = True
+                        got_chapter = False
+                    if self.fail_safe_rendering:
+                        if not self.articleRenderingOK(art, output):
+                            art.renderFailed = True
+                    self.bookmark_ns = 'a%d.' % i
+                    art_elements = self.layoutArticle(art)
+                    self.bookmark_ns = ''
+                    del art
+                    yield ('article', i, has_chapter, 'a%d.' % i, art_elements)
+        finally:
+            # the end of the pipeline is never read, the stages have to be shut down
+            if stage is not None:
+                stage.close()
+
+    def _testDoc(self):
+        """Return a document which can be used to test render elements
+        that were laid out for self.doc"""
+        testdoc = self.doc.__class__(os.path.join(self.tmpdir, 'test.pdf'),
+                                     topMargin=pdfstyles.page_margin_top,
+                                     leftMargin=pdfstyles.page_margin_left,
+                                     rightMargin=pdfstyles.page_margin_right,
+                                     bottomMargin=pdfstyles.page_margin_bottom,
+                                     title='',
+                                     )
+        for pt in getattr(self.doc, 'pageTemplates', None) or getattr(self.doc, 'templates', []):
+            testdoc.addPageTemplates(pt)
+        return testdoc
+
+    def segmentsRenderingOK(self, segment_indices):
+        def elements():
+            for idx in segment_indices:
+                for e in self.spool[idx]:
+                    yield e
+        try:
+            self._testDoc().build(elements())
+            return True
+        except MemoryError:
+            raise
+        except:
+            log.error('test rendering failed for %d segment(s)' % len(segment_indices))
+            log.error(traceback.format_exc())
+            return False
+
+    def findFailedArticles(self):
+        """Bisect the spooled articles to find the ones that can not be
+        rendered.
+
+        @returns: spool indices of the failed articles
+        """
+        articles = [idx for (idx, info) in enumerate(self.spool.info) if info[0] == 'article']
+        failed = []
+        # the whole book is known to be broken. start with the two halves
+        todo = [articles[len(articles)//2:], articles[:len(articles)//2]]
+        while todo:
+            group = todo.pop()
+            if not group or self.segmentsRenderingOK(group):
+                continue
+            if len(group) == 1:
+                failed.append(group[0])
+            else:
+                todo.extend([group[len(group)//2:], group[:len(group)//2]])
+        return failed
+
+    def iterRecoveredElements(self):
+        """Yield the spooled elements of the book. Articles that can not be
+        rendered are laid out again as plain text."""
+        failed = set(self.findFailedArticles())
+        self.toc_entries = []
+        item_list = self.env.metabook.walk()
+        failed_ns = []
+        for idx in failed:
+            kind, item_idx, has_chapter, bookmark_ns = self.spool.info[idx]
+            log.warning('marking article as failed: %r' % item_list[item_idx].title)
+            failed_ns.append(bookmark_ns)
+        # outline entries of failed articles point to anchors which are gone,
+        # the entries of the new layout take their place
+        bookmarks = []
+        positions = {} # bookmark namespace -> index of its first entry in bookmarks
+        for bm in self.bookmarks:
+            ns = [ns for ns in failed_ns if bm[2].startswith(ns)]
+            if ns:
+                positions.setdefault(ns[0], len(bookmarks))
+            else:
+                bookmarks.append(bm)
+        self.doc.bookmarks = bookmarks
+        inserted = 0
+        pos = 0
+
+        for idx in range(len(self.spool)):
+            kind, item_idx, has_chapter, bookmark_ns = self.spool.info[idx]
+            if kind == 'appendix':
+                continue
+            if idx in failed:
+                layout = self.layoutArticleIsolated(item_list[item_idx],
+                                                    has_preceeding_chapter=has_chapter,
+                                                    bookmark_ns='f%d.' % item_idx,
+                                                    render_failed=True)
+                elements = layout.elements if layout else []
+                if layout:
+                    pos = positions.get(bookmark_ns, pos)
+                    bookmarks[pos + inserted:pos + inserted] = layout.bookmarks
+                    inserted += len(layout.bookmarks)
+            else:
+                elements = self.spool[idx]
+            for e in elements:
+                yield e
+
+    def articleJobs(self, item_list):
+        """Return a tuple (index of the item, preceeded by chapter, number of
+        previous occurrences of the same article) for every article of item_list"""
+        jobs = []
+        seen = {}
+        got_chapter = False
         for (i, item) in enumerate(item_list):
             if item.type == 'chapter':
-                chapter = parser.Chapter(item.title.strip())
-                if len(item_list) > i+1 and item_list[i+1].type == 'article':
-                    chapter.next_article_title = item_list[i+1].title
-                else:
-                    chapter.next_article_title = ''
-                elements.extend(self.writeChapter(chapter))
                 got_chapter = True
             elif item.type == 'article':
-                art = self.buildArticle(item)
-                self.imgDB = item.images
-                self.license_checker.image_db = self.imgDB
-                if not art:
+                occurrence = seen.get((item.title, item.revision), 0)
+                seen[(item.title, item.revision)] = occurrence + 1
+                jobs.append((i, got_chapter, occurrence))
+                got_chapter = False
+        return jobs
+
+    def articlePipeline(self, item_list):
+        """Fetch and prepare the articles of item_list in background
+        stages. The upcoming articles are fetched concurrently in a pool
+        of prefetch_threads threads. Yields a tuple (job, cache key, article,
+        images) for each article item, in metabook order. The article is
+        the cached ArticleLayout if one is found, the prepared article or
+        None otherwise. images are the pending results of the image pool,
+        see submitArticleImages.
+        """
+        use_cache = self.render_cache is not None and not self.fail_safe_rendering
+        if use_cache:
+            # pdfstyles.word_wrap follows the direction of the node being written,
+            # the digest has to be taken before the layout starts
+            self.styleDigest()
+
+        def fetch(job):
+            item = item_list[job[0]]
+            cache_key = None
+            if use_cache:
+                cache_key = self.articleCacheKey(item, has_preceeding_chapter=job[1], occurrence=job[2])
+                layout = self.readCachedLayout(cache_key)
+                if layout is not None:
+                    return (job, cache_key, layout, [])
+            art = self.fetchArticle(item)
+            return (job, cache_key, art, self.submitArticleImages(item, art))
+
+        tc = self.makeTreeCleaner() # self.tc is used by the main thread
+
+        def prepare((job, cache_key, art, images)):
+            if not isinstance(art, ArticleLayout):
+                art = self.prepareArticle(art, tc=tc)
+            return (job, cache_key, art, images)
+
+        if self.image_workers > 0 and self.image_pool is None:
+            # forked before the prefetch threads are started
+            self.image_pool = multiprocessing.Pool(self.image_workers)
+
+        fetched = prefetch(fetch, self.articleJobs(item_list),
+                           threads=self.prefetch_threads,
+                           window=self.prefetch_threads + self.pipeline_depth)
+        return pipeline(fetched, [prepare], maxsize=self.pipeline_depth)
+
+    def styleDigest(self):
+        """Digest of the effective layout configuration, i.e. pdfstyles
+        including the values overridden in customconfig and the css map."""
+        if self._style_digest is None:
+            values = []
+            for name, value in sorted(vars(pdfstyles).items()):
+                if name.startswith('_'):
                     continue
-                if got_chapter:
-                    art.has_preceeding_chapter = True
-                    got_chapter = False
-                if self.fail_safe_rendering:
-                    if not self.articleRenderingOK(copy.deepcopy(art), output):
-                        art.renderFailed = True
-                art_elements = self.writeArticle(art)
-                del art
-                elements.extend(self.groupElements(art_elements))
-
+                r = _configRepr(value)
+                if r is not None:
+                    values.append((name, r))
+            values.append(('css_map', repr(sorted(css_map.items()))))
+            self._style_digest = md5(repr(values)).hexdigest()
+        return self._style_digest
+
+    def articleCacheKey(self, item, has_preceeding_chapter=False, occurrence=0):
+        """Key of the cached layout of item. Called from the prefetch
+        threads, so it only depends on the item and on writer state which
+        does not change during layout. Direction changes inside an article
+        follow from its revision, the article starts in self.base_rtl."""
+        source = self.getSource(item)
+        if source:
+            wikiurl = source.url
+        else:
+            wikiurl = item.title
+        key = repr((wikiurl, item.title, item.displaytitle, item.revision,
+                    has_preceeding_chapter, occurrence, self.lang, self.base_rtl,
+                    self.styleDigest(), str(mwlibversion), str(rlwriterversion), ArticleLayout.version))
+        return md5(key).hexdigest()
+
+    def readCachedLayout(self, cache_key):
+        data = self.render_cache.get(cache_key)
+        if data is None:
+            return None
         try:
-            self.renderBook(elements, output, coverimage=coverimage)
-            log.info('RENDERING OK')
-            shutil.rmtree(self.tmpdir, ignore_errors=True)
-            return
-        except MemoryError:
-            shutil.rmtree(self.tmpdir, ignore_errors=True)
-            raise
+            return cPickle.loads(data)
         except Exception, err:
-            traceback.print_exc()
-            log.error('RENDERING FAILED: %r' % err)
-            if self.fail_safe_rendering:
-                log.error('GIVING UP')
-                shutil.rmtree(self.tmpdir, ignore_errors=True)
-                raise RuntimeError('Giving up.')
-            else:
-                self.fail_safe_rendering = True
-                self.writeBook(output, coverimage=coverimage, status_callback=status_callback)
+            log.warning('invalid render cache entry %r: %r' % (cache_key, err))
+            return None
 
+    def storeCachedLayout(self, cache_key, layout):
+        try:
+            self.render_cache.put(cache_key, cPickle.dumps(layout, cPickle.HIGHEST_PROTOCOL))
+        except Exception, err:
+            log.warning('could not store layout in render cache: %r' % err)
+
+    def cachedLayoutValid(self, layout):
+        """Check if a cached layout can be used in the current book: internal
+        links need to resolve the same way and all images need to have
+        the same content. The image DB of every job has its own location,
+        the layout is pointed at the images of this book."""
+        for article_id, internal in layout.link_deps.iteritems():
+            if (article_id in self.articleids) != internal:
+                return False
+        moved = {}
+        for target, digest, path, size in layout.image_deps:
+            if target is None:
+                if not os.path.exists(path):
+                    return False
+                continue
+            img_path = self.getImgPath(target)
+            if (self.imageDigest(img_path) if img_path else None) != digest:
+                return False
+            if path is None:
+                continue
+            # prepared the same way as in writeImageLink
+            repaired_path = self._fixBrokenImages(None, img_path)
+            if not repaired_path:
+                return False
+            new_path = self.resampleImage(repaired_path, *size)
+            if new_path != path:
+                moved[path] = new_path
+        if moved:
+            self.relocateImages(layout.elements, moved)
+        return True
 
-    def renderBook(self, elements, output, coverimage=None):
-        if pdfstyles.show_article_attribution:
-            elements.append(TocEntry(txt=_('References'), lvl='group'))
-            elements.append(self._getPageTemplate(_('Article Sources and Contributors')))
-            elements.append(NotAtTopPageBreak())
-            elements.extend(self.writeArticleMetainfo())
-            elements.append(self._getPageTemplate(_('Image Sources, Licenses and Contributors')))
-            if self.numarticles > 1:
-                elements.append(NotAtTopPageBreak())
-            elements.extend(self.writeImageMetainfo())
+    def relocateImages(self, elements, moved):
+        """Replace the image paths in elements according to moved, a dict
+        mapping the old to the new path"""
+        moved_src = [(u'src="%s"' % unicode(old, 'utf-8'), u'src="%s"' % unicode(new, 'utf-8'))
+                     for (old, new) in moved.items()]
+        for e in elements:
+            if isinstance(e, Figure) and e.imgPath in moved:
+                e.imgPath = moved[e.imgPath]
+            text = getattr(e, 'text', None)
+            if isinstance(text, basestring) and 'src="' in text:
+                for old, new in moved_src:
+                    text = text.replace(old, new)
+                e.text = text
+            self.relocateImages(getattr(e, 'flowables', None) or [], moved)
+
+    def layoutArticleIsolated(self, item, has_preceeding_chapter=False, bookmark_ns='', render_failed=False,
+                              occurrence=0):
+        """Lay out a single article with empty side tables, see
+        layoutPreparedArticle. The layout is taken from the render cache
+        if possible.
+
+        @rtype: ArticleLayout or None
+        """
+        cache_key = None
+        if self.render_cache is not None and not render_failed and not self.fail_safe_rendering:
+            cache_key = self.articleCacheKey(item, has_preceeding_chapter=has_preceeding_chapter,
+                                             occurrence=occurrence)
+            layout = self.readCachedLayout(cache_key)
+            if layout is not None:
+                self.imgDB = item.images
+                self.license_checker.image_db = self.imgDB
+                if self.cachedLayoutValid(layout):
+                    return layout
+        return self.layoutPreparedArticle(item, self.buildArticle(item),
+                                          has_preceeding_chapter=has_preceeding_chapter,
+                                          bookmark_ns=bookmark_ns,
+                                          render_failed=render_failed,
+                                          cache_key=cache_key)
+
+    def layoutPreparedArticle(self, item, art, has_preceeding_chapter=False, bookmark_ns='', render_failed=False,
+                              cache_key=None):
+        """Lay out a single prepared article with empty side tables.
+
+        The state of the writer is restored afterwards, the elements and
+        side tables of the article are returned as ArticleLayout. If a
+        cache_key is given the layout is stored in the render cache.
+
+        @rtype: ArticleLayout or None
+        """
+        saved = (self.bookmarks, self.bookmark_ns, self.img_meta_info,
+                 self.img_count, self.article_meta_info, self.layout_status,
+                 self.url_map, self.ref_name_map, self.image_deps, self.link_deps,
+                 self.page_templates, self.node_timer)
+        self.bookmarks = []
+        if cache_key:
+            # cached layouts are reused in other books, so bookmarks can't be named by position
+            bookmark_ns = 'k%s.' % cache_key[:12]
+        self.bookmark_ns = bookmark_ns
+        self.img_meta_info = {}
+        self.img_count = 0
+        self.article_meta_info = []
+        self.layout_status = None
+        self.url_map = {}
+        self.ref_name_map = {}
+        self.image_deps = []
+        self.link_deps = {}
+        self.page_templates = []
+        if self.node_timer is not None:
+            self.node_timer = NodeTimer()
+        try:
+            self.imgDB = item.images
+            self.license_checker.image_db = self.imgDB
+            if not art:
+                return None
+            if self.node_timer is not None:
+                for (name, seconds) in getattr(art, 'pass_timing', None) or []:
+                    self.node_timer.addPass(name, seconds)
+            if has_preceeding_chapter:
+                art.has_preceeding_chapter = True
+            if render_failed:
+                art.renderFailed = True
+            elements = self.layoutArticle(art)
+            layout = ArticleLayout(art.caption, elements, self.bookmarks,
+                                   self.img_meta_info, self.article_meta_info,
+                                   bookmark_ns=bookmark_ns)
+            layout.page_templates = self.page_templates
+            if cache_key:
+                layout.image_deps = self.image_deps
+                layout.link_deps = self.link_deps
+                self.storeCachedLayout(cache_key, layout)
+            layout.timing = self.node_timer
+            return layout
+        finally:
+            (self.bookmarks, self.bookmark_ns, self.img_meta_info,
+             self.img_count, self.article_meta_info, self.layout_status,
+             self.url_map, self.ref_name_map, self.image_deps, self.link_deps,
+             self.page_templates, self.node_timer) = saved
+
+    def layoutArticlesInPool(self, item_list):
+        """Lay out all articles of item_list in a pool of forked worker
+        processes. Yields one ArticleLayout (or None if the article could
+        not be built) per article, in metabook order.
+        """
+        global _pool_writer, _pool_items
+        jobs = self.articleJobs(item_list)
+        _pool_writer, _pool_items = self, item_list
+        pool = multiprocessing.Pool(self.workers, initializer=_initLayoutWorker)
+        # only a limited number of articles is in flight at any time.
+        # otherwise finished layouts would pile up in memory
+        window = self.workers + self.pipeline_depth
+        pending = deque()
+        jobs = iter(jobs)
+        try:
+            for job in itertools.islice(jobs, window):
+                pending.append((job, pool.apply_async(_layoutArticleInWorker, (job,))))
+            while pending:
+                (i, got_chapter, occurrence), result = pending.popleft()
+                for job in itertools.islice(jobs, 1):
+                    pending.append((job, pool.apply_async(_layoutArticleInWorker, (job,))))
+                try:
+                    layout = result.get()
+                except Exception, err:
+                    log.warning('layout worker failed for %r, laying out serially: %r' % (item_list[i].title, err))
+                    layout = self.layoutArticleIsolated(item_list[i],
+                                                        has_preceeding_chapter=got_chapter,
+                                                        bookmark_ns='a%d.' % i,
+                                                        occurrence=occurrence)
+                yield layout
+        finally:
+            pool.terminate()
+            _pool_writer = _pool_items = None
+
+    def mergeArticleLayout(self, layout):
+        """Add the side tables of an ArticleLayout to the book wide
+        tables and return its elements."""
+        self.bookmarks.extend(layout.bookmarks)
+        if self.node_timer is not None and layout.timing is not None:
+            self.node_timer.merge(layout.timing)
+        for (title, rtl) in layout.page_templates:
+            self.doc.addPageTemplates(WikiPage(title, rtl=rtl))
+        for (_id, name, url, license, authors) in sorted(layout.img_meta_info.values()):
+            if not self.img_meta_info.get(name):
+                self.img_count += 1
+                self.img_meta_info[name] = (self.img_count, name, url, license, authors)
+        self.article_meta_info.extend(layout.article_meta_info)
+        if self.layout_status:
+            self.articlecount += 1
+            self.layout_status(article=layout.caption)
+            if self.numarticles:
+                self.layout_status(progress=100*self.articlecount/self.numarticles)
+        return layout.elements
 
-        if not self.debug:
-            elements.extend(self.renderLicense())
+    def renderBook(self, elements, output, coverimage=None, appendix=None):
+        if appendix is None:
+            appendix = self.iterBookAppendix()
+        elements = itertools.chain(elements, appendix)
 
         self.render_status(status='rendering', article='')
 
@@ -537,7 +1315,7 @@ class RlWriter(object):
             if linuxmem:
                 log.info('memory usage after laying out:', linuxmem.memory())
             self.doc.build(elements)
-            if pdfstyles.render_toc and self.numarticles > 1:
+            if pdfstyles.render_toc and self.numarticles > 1 and self.toc_entries:
                 err = self.toc_renderer.build(output, self.toc_entries, has_title_page=bool(self.book.title), rtl=self.rtl)
                 if err:
                     log.warning('TOC not rendered. Probably pdftk is not properly installed. returncode: %r' % err)
@@ -547,13 +1325,170 @@ class RlWriter(object):
             traceback.print_exc()
             log.info('rendering failed - trying safe rendering')
             raise
+        self.dumpLicenseStats()
 
+    def dumpLicenseStats(self):
         license_stats_dir = os.environ.get('MWLIBLICENSESTATS')
         if license_stats_dir and os.path.exists(license_stats_dir):
             self.license_checker.dumpUnknownLicenses(license_stats_dir)
             if self.debug:
                 print self.license_checker.dumpStats()
 
+    def useShards(self):
+        return (self.shards > 1
+                and self.spool is not None
+                and self.numarticles >= self.shards
+                and shards.havePdftk())
+
+    def splitShards(self, num):
+        """Split the spooled segments into at most num shards of about the
+        same size. Shards only start with chapters, articles which are
+        not preceeded by a chapter or the appendix.
+
+        @returns: list of lists of spool indices
+        """
+        target = sum(self.spool.sizes) / num
+        result = [[]]
+        size = 0
+        for (idx, (kind, item_idx, has_chapter, bookmark_ns)) in enumerate(self.spool.info):
+            can_split = kind in ('chapter', 'appendix') or (kind == 'article' and not has_chapter)
+            if can_split and result[-1] and len(result) < num and size >= target * len(result):
+                result.append([])
+            result[-1].append(idx)
+            size += self.spool.sizes[idx]
+        return result
+
+    def _shardDoc(self, path, shard_idx):
+        return BaseDocTemplate(path,
+                               topMargin=pdfstyles.page_margin_top,
+                               leftMargin=pdfstyles.page_margin_left,
+                               rightMargin=pdfstyles.page_margin_right,
+                               bottomMargin=pdfstyles.page_margin_bottom,
+                               title=self.book.title,
+                               keywords=self.getVersion(),
+                               shard=shard_idx,
+        )
+
+    def renderShard(self, shard_idx, segment_indices, path):
+        """Render the spooled segments to the PDF path. Pages are not
+        numbered and the PDF has no outline.
+
+        @returns: (number of pages, toc entries, page of every anchor)
+        """
+        self.spool.reopen()
+        doc = self._shardDoc(path, shard_idx)
+        toc_entries = []
+        if pdfstyles.render_toc:
+            doc.tocCallback = toc_entries.append
+
+        def elements():
+            for idx in segment_indices:
+                for e in self.spool[idx]:
+                    yield e
+
+        doc.build(elements())
+        page_count = doc.page_count
+        if page_count is None:
+            page_count = shards.countPages(path)
+        return (page_count, toc_entries, doc.bookmark_pages)
+
+    def renderBookSharded(self, elements, output):
+        """Lay out the whole book into the spool, render it in shards
+        in parallel processes and stitch the shards together."""
+        global _pool_writer
+        unspooled = [] # elements laid out after spooling failed
+        for e in elements:
+            if self.spool_failed:
+                unspooled.append(e)
+        appendix = []
+        if not self.spool_failed:
+            appendix = list(self.iterBookAppendix())
+            try:
+                self.spool.append(('appendix', None, False, ''), appendix)
+            except Exception, err:
+                log.warning('can not spool the appendix: %r' % err)
+                self.spool_failed = True
+        if self.spool_failed:
+            # the shards are rendered from the spool, which misses segments
+            log.warning('rendering the book without shards')
+            self.renderBook(self.iterSpooledElements(unspooled), output, appendix=appendix or None)
+            return
+
+        self.render_status(status='rendering', article='')
+        log.info("start sharded rendering: %r" % output)
+        jobs = [(shard_idx, segment_indices, os.path.join(self.tmpdir, 'shard%d.pdf' % shard_idx))
+                for (shard_idx, segment_indices) in enumerate(self.splitShards(self.shards))]
+        _pool_writer = self
+        pool = multiprocessing.Pool(len(jobs), initializer=_initLayoutWorker)
+        try:
+            results = pool.map(_renderShardInWorker, jobs)
+        finally:
+            pool.terminate()
+            _pool_writer = None
+
+        page_offset = 0 # pages of the previous shards
+        bookmark_pages = {}
+        self.toc_entries = []
+        for ((shard_idx, segment_indices, path), (page_count, toc_entries, dest_pages)) in zip(jobs, results):
+            for (lvl, txt, page) in toc_entries:
+                self.toc_entries.append((lvl, txt, page_offset + page))
+            for (key, page) in dest_pages.items():
+                bookmark_pages[key] = page_offset + page
+            page_offset += page_count
+        # every page is numbered, like in a book rendered as a whole
+        page_numbers = dict((page, page) for page in range(1, page_offset + 1))
+
+        stitched = os.path.join(self.tmpdir, 'stitched.pdf')
+        shards.concatenate([path for (shard_idx, segment_indices, path) in jobs], stitched)
+        shards.stampPageNumbers(stitched, page_numbers, output)
+        self.render_status(status='rendering', progress=90)
+
+        has_title_page = bool(self.book.title)
+        if pdfstyles.render_toc and self.numarticles > 1 and self.toc_entries:
+            err = self.toc_renderer.build(output, self.toc_entries, has_title_page=has_title_page, rtl=self.rtl)
+            if err:
+                log.warning('TOC not rendered. Probably pdftk is not properly installed. returncode: %r' % err)
+        toc_pages = shards.countPages(output) - page_offset
+        outline = []
+        for (title, key, lvl, closed) in outlineEntries(self.bookmarks):
+            if key not in bookmark_pages:
+                continue
+            page = bookmark_pages[key]
+            if page > 1 or not has_title_page: # the toc is inserted after the title page
+                page += toc_pages
+            outline.append((title, lvl + 1, page))
+        shutil.move(output, stitched)
+        shards.setOutline(stitched, outline, output)
+        self.dumpLicenseStats()
+
+    def iterSpooledElements(self, unspooled):
+        """Yield the elements of the book from the spool, followed by the
+        elements laid out after spooling failed."""
+        for idx in range(len(self.spool)):
+            for e in self.spool[idx]:
+                yield e
+        for e in unspooled:
+            yield e
+
+    def iterBookAppendix(self):
+        """Yield the attribution and license sections. They are only laid
+        out once all articles have been consumed."""
+        elements = []
+        if pdfstyles.show_article_attribution:
+            elements.append(TocEntry(txt=_('References'), lvl='group'))
+            elements.append(self._getPageTemplate(_('Article Sources and Contributors')))
+            elements.append(NotAtTopPageBreak())
+            elements.extend(self.writeArticleMetainfo())
+            elements.append(self._getPageTemplate(_('Image Sources, Licenses and Contributors')))
+            if self.numarticles > 1:
+                elements.append(NotAtTopPageBreak())
+            elements.extend(self.writeImageMetainfo())
+
+        if not self.debug:
+            elements.extend(self.renderLicense())
+        for e in elements:
+            yield e
+
     def renderLicense(self):
         self.license_mode = True
         elements = []
@@ -570,20 +1505,34 @@ class RlWriter(object):
         return elements
 
 
+    def getSource(self, item):
+        """Memoized item.wiki.getSource"""
+        key = (id(item.wiki), item.title, item.revision)
+        try:
+            return self.source_cache[key]
+        except KeyError:
+            pass
+        self.wiki_lock.acquire()
+        try:
+            source = self.source_cache[key] = item.wiki.getSource(item.title, item.revision)
+        finally:
+            self.wiki_lock.release()
+        return source
+
     def getArticleIDs(self):
-        self.articleids=[]
-        for item in self.env.metabook.walk():
-            if item.type != 'article':
-                continue
+        self.articleids = set()
+        self.item_articleids = {}
+        items = [(i, item) for (i, item) in enumerate(self.env.metabook.walk()) if item.type == 'article']
+        sources = prefetch(self.getSource, [item for (i, item) in items], threads=self.prefetch_threads)
+        for ((i, item), source) in itertools.izip(items, sources):
             title = item.displaytitle or item.title
-
-            source = item.wiki.getSource(item.title, item.revision)
             if source:
                 wikiurl = source.url
             else:
                 wikiurl = item.title
             article_id = self.buildArticleID(wikiurl, title)
-            self.articleids.append(article_id)
+            self.articleids.add(article_id)
+            self.item_articleids[i] = article_id
 
     def tocCallback(self, info):
         self.toc_entries.append(info)
@@ -617,8 +1566,11 @@ class RlWriter(object):
 
     def _getPageTemplate(self, title):
         template_title =self.renderArticleTitle(title)
-        page_template = WikiPage(template_title, rtl=self.rtl)
-        self.doc.addPageTemplates(page_template)
+        if self.page_templates is not None:
+            # isolated layout: the templates are added when the layout is merged
+            self.page_templates.append((template_title, self.rtl))
+        else:
+            self.doc.addPageTemplates(WikiPage(template_title, rtl=self.rtl))
         return NextPageTemplate(template_title.encode('utf-8'))
 
     def writeChapter(self, chapter):
@@ -626,8 +1578,7 @@ class RlWriter(object):
 
         title = self.renderArticleTitle(chapter.caption)
         if self.inline_mode == 0 and self.table_nesting==0:
-            chapter_anchor = '<a name="%s" />' % len(self.bookmarks)
-            self.bookmarks.append((title, 'chapter'))
+            chapter_anchor = self.addBookmark(title, 'chapter')
         else:
             chapter_anchor = ''
         chapter_para = Paragraph('%s%s' % (title, chapter_anchor), heading_style('chapter'))
@@ -658,16 +1609,17 @@ class RlWriter(object):
         self.formatter.sectiontitle_mode = False
 
         if 1 <= lvl <= 4 and self.inline_mode == 0 and self.table_nesting==0:
-            anchor = '<a name="%d"/>' % len(self.bookmarks)
             bm_type = 'article' if lvl==1 else 'heading%s' % lvl
-            self.bookmarks.append((obj.children[0].getAllDisplayText(), bm_type))
+            anchor = self.addBookmark(obj.children[0].getAllDisplayText(), bm_type)
         else:
             anchor = ''
         elements = [Paragraph('<font name="%s"><b>%s</b></font>%s' % (headingStyle.fontName, heading_txt, anchor), headingStyle)]
 
         if self.table_size_calc == 0:
-            obj.removeChild(obj.children[0])
-        elements.extend(self.renderMixed(obj))
+            # the heading is already rendered
+            elements.extend(self.renderMixed(obj, children=obj.children[1:]))
+        else:
+            elements.extend(self.renderMixed(obj))
 
         return elements
 
@@ -683,6 +1635,14 @@ class RlWriter(object):
         return elements
 
     def buildArticleID(self, wikiurl, article_name):
+        key = (wikiurl, article_name)
+        try:
+            return self._article_id_cache[key]
+        except KeyError:
+            article_id = self._article_id_cache[key] = self._buildArticleID(wikiurl, article_name)
+            return article_id
+
+    def _buildArticleID(self, wikiurl, article_name):
         tmplink = advtree.Link()
         tmplink.target = article_name
         tmplink.capitalizeTarget = True # this is a hack, this info should pulled out of the environment if available
@@ -758,6 +1718,19 @@ class RlWriter(object):
                 self.cleanTitle(c)
 
     def renderArticleTitle(self, raw):
+        """Render a title as inline markup. Titles are cached by text and
+        direction, titles without wiki markup are not parsed at all."""
+        key = (raw, self.rtl)
+        res = self.title_cache.get(key)
+        if res is None:
+            if _title_markup_re.search(raw):
+                res = self._parseAndRenderTitle(raw)
+            else:
+                res = self.renderText(raw)
+            self.title_cache.put(key, res)
+        return res
+
+    def _parseAndRenderTitle(self, raw):
         dummydb = DummyDB()
         title_node = uparser.parseString(title='', raw=raw, wikidb=dummydb)
         advtree.buildAdvancedTree(title_node)
@@ -766,10 +1739,31 @@ class RlWriter(object):
         res = self.renderInline(title_node)
         return ''.join(res)
 
+    def layoutArticle(self, article):
+        """Write an article and group its elements"""
+        return self.groupElements(self.writeArticle(article))
+
     def writeArticle(self, article):
+        timed = self.node_timer is not None
+        if timed:
+            self.node_timer.startArticle(article.caption)
+            self.node_timer.enter('writeArticle')
+        try:
+            return self._writeArticle(article)
+        finally:
+            # links of the next article must not resolve against this one
+            self.article_wikiurl = ''
+            if timed:
+                self.node_timer.leave()
+                self.node_timer.endArticle()
+
+    def _writeArticle(self, article):
         if self.license_mode and self.debug:
             return []
         self.references = []
+        self.ref_nums = {}
+        self.lstrip_leaves = set()
+        self.article_wikiurl = getattr(article, 'wikiurl', '')
         title = self.renderArticleTitle(article.caption)
 
         log.info('rendering: %r' % (article.url or article.caption))
@@ -793,8 +1787,7 @@ class RlWriter(object):
                     elements.append(CondPageBreak(pdfstyles.article_start_min_space))
 
         if self.inline_mode == 0 and self.table_nesting==0:
-            heading_anchor = '<a name="%d"/>' % len(self.bookmarks)
-            self.bookmarks.append((article.caption, 'article'))
+            heading_anchor = self.addBookmark(article.caption, 'article')
         else:
             heading_anchor = ''
 
@@ -845,8 +1838,8 @@ class RlWriter(object):
     def writeParagraph(self,obj):
         first_leaf = obj.getFirstLeaf()
         if hasattr(first_leaf, 'caption'):
-            first_leaf.caption = first_leaf.caption.lstrip()
-        if getattr(obj, 'is_header', False):
+            self.lstrip_leaves.add(id(first_leaf))
+        if getattr(obj, 'is_header', False) or self.inHeaderCell(obj):
             style = text_style(mode='center', in_table=self.table_nesting)
         else:
             style = None
@@ -873,20 +1866,32 @@ class RlWriter(object):
         figures = []
         lastNode = None
 
+        # running totals of gotSufficientFloats. figures and paragraphs are only
+        # added as long as the lists are the same, so only new ones are measured
+        totals = {'figures': None, 'num_figures': 0, 'hf': 0, 'maxImgWidth': 0,
+                  'paras': None, 'num_paras': 0, 'hp': 0}
+
         def gotSufficientFloats(figures, paras):
-            hf = 0
-            hp = 0
-            maxImgWidth = 0
-            for f in figures:
-                # assume 40 chars per line for caption text
-                hf += f.imgHeight + f.margin[0] + f.margin[2] + f.padding[0] + f.padding[2] + f.cs.leading * max(int(len(f.captionTxt) / 40), 1)
-                maxImgWidth = max(maxImgWidth, f.imgWidth)
-            for p in paras:
+            if figures is not totals['figures'] or len(figures) < totals['num_figures']:
+                totals.update(figures=figures, num_figures=0, hf=0, maxImgWidth=0, paras=None)
+            if len(figures) > totals['num_figures']:
+                maxImgWidth = totals['maxImgWidth']
+                for f in figures[totals['num_figures']:]:
+                    # assume 40 chars per line for caption text
+                    totals['hf'] += f.imgHeight + f.margin[0] + f.margin[2] + f.padding[0] + f.padding[2] + f.cs.leading * max(int(len(f.captionTxt) / 40), 1)
+                    maxImgWidth = max(maxImgWidth, f.imgWidth)
+                totals['num_figures'] = len(figures)
+                if maxImgWidth != totals['maxImgWidth']:
+                    totals.update(maxImgWidth=maxImgWidth, paras=None) # paragraphs need to be measured again
+            if paras is not totals['paras'] or len(paras) < totals['num_paras']:
+                totals.update(paras=paras, num_paras=0, hp=0)
+            for p in paras[totals['num_paras']:]:
                 if isinstance(p,Paragraph):
-                    w,h = p.wrap(print_width - maxImgWidth, print_height)
+                    h = wrappedHeight(p, print_width - totals['maxImgWidth'], print_height)
                     h += p.style.spaceBefore + p.style.spaceAfter
-                    hp += h
-            if hp > hf - 10:
+                    totals['hp'] += h
+            totals['num_paras'] = len(paras)
+            if totals['hp'] > totals['hf'] - 10:
                 return True
             else:
                 return False
@@ -1015,7 +2020,7 @@ class RlWriter(object):
         style = text_style(mode='preformatted', in_table=self.table_nesting)
         while not width or width > avail_width:
             pre = XPreformatted(t, style)
-            width, height = pre.wrap(avail_width, pdfstyles.page_height)
+            width, height = wrap_cache.size(pre, avail_width, pdfstyles.page_height)
             style.fontSize -= .5
             if style.fontSize < pdfstyles.min_preformatted_size:
                 style = text_style(mode='preformatted', in_table=self.table_nesting)
@@ -1032,10 +2037,12 @@ class RlWriter(object):
         return self.formatter.styleText(txt, kwargs)
 
     def writeText(self, obj):
-        return [self.renderText(obj.caption)]
+        if self.lstrip_leaves and id(obj) in self.lstrip_leaves:
+            return InlineRun([self.renderText(obj.caption.lstrip())])
+        return InlineRun([self.renderText(obj.caption)])
 
     def renderInline(self, node):
-        txt = []
+        txt = InlineRun()
         self.inline_mode += 1
         for child in node.children:
             res = self.write(child)
@@ -1053,7 +2060,11 @@ class RlWriter(object):
             txt.append('</font>')
         return txt
 
-    def renderMixed(self, node, para_style=None, textPrefix=None):
+    def renderMixed(self, node, para_style=None, textPrefix=None, children=None):
+        """Render the children of node, or only the given children, as
+        paragraphs and the block elements between them."""
+        if children is None:
+            children = node.children
         if not para_style:
             if self.license_mode:
                 para_style = text_style("license")
@@ -1063,7 +2074,8 @@ class RlWriter(object):
             para_style.fontSize = max(text_style('license').fontSize, para_style.fontSize - 4)
             para_style.leading = 1
 
-        math_nodes = node.getChildNodesByClass(advtree.Math)
+        math_nodes = [n for c in children for n in itertools.chain([c], c.allchildren())
+                      if isinstance(n, advtree.Math)]
         if math_nodes:
             max_source_len = max([len(math.caption) for math in math_nodes])
             if max_source_len > pdfstyles.no_float_math_len:
@@ -1094,7 +2106,7 @@ class RlWriter(object):
                 'start': ['<b>'],
                 'end': ['</b>'],
                 }
-        for c in node:
+        for c in children:
             res = self.write(c)
             if isInline(res):
                 txt.extend(res)
@@ -1186,13 +2198,11 @@ class RlWriter(object):
         #looking for internal links
         internallink = False
         if isinstance(obj, advtree.ArticleLink) and obj.url:
-            a = obj.getParentNodesByClass(advtree.Article)
-            wikiurl = ''
-            if a:
-                wikiurl = getattr(a[0], 'wikiurl', '')
-            article_id = self.buildArticleID(wikiurl, obj.full_target)
+            article_id = self.buildArticleID(self.article_wikiurl, obj.full_target)
             if article_id in self.articleids:
                 internallink = True
+            if self.link_deps is not None:
+                self.link_deps[article_id] = internallink
 
         if not href:
             log.warning('no link target specified')
@@ -1295,19 +2305,12 @@ class RlWriter(object):
         return [''.join(txt)] #FIXME use writelink to generate clickable-link
 
 
-    def svg2png(self, img_path ):
-        cmd = ["convert", img_path, "-flatten", "-coalesce",  "-strip", img_path+".png"]
+    def svg2png(self, img_path):
         try:
-            p = subprocess.Popen(cmd, shell=False)
-            pid, status = os.waitpid(p.pid, 0)
-            if status != 0 :
-                log.warning('img could not be converted. convert exited with non-zero return code:', repr(cmd))
-                return ''
-            else:
-                return '%s.png' % img_path
-        except OSError:
-            log.warning('img could not be converted. cmd failed:', repr(cmd))
-            return ''
+            return self.converted_svgs[img_path]
+        except KeyError:
+            png_path = self.converted_svgs[img_path] = imageprep.convertSVG(img_path, cache=self.image_cache)
+            return png_path
 
     def getImgPath(self, target):
         if self.imgDB:
@@ -1325,67 +2328,99 @@ class RlWriter(object):
             imgPath = ''
         return imgPath
 
+    def imageDigest(self, img_path):
+        """Memoized content digest of an image, None if it can't be read"""
+        try:
+            return self.image_digests[img_path]
+        except KeyError:
+            pass
+        try:
+            digest = imageprep.fileDigest(img_path)
+        except EnvironmentError:
+            digest = None
+        self.image_digests[img_path] = digest
+        return digest
+
+    def addImageDep(self, target, img_path=None, path=None, size=None):
+        """Record an image of the article for the render cache: the image
+        target, the content digest of the image it was found at, the path
+        of the prepared image used by the elements (None if the image was
+        not used) and the print size it was prepared for. Files written
+        by the writer itself are recorded with target None."""
+        if self.image_deps is None:
+            return
+        if target is None:
+            self.image_deps.append((None, None, path, None))
+        else:
+            digest = self.imageDigest(img_path) if img_path else None
+            self.image_deps.append((target, digest, path, size))
+
+    def resampleImage(self, img_path, w, h):
+        """Downsample the image to pdfstyles.img_print_dpi for a print size of w x h points"""
+        dpi = pdfstyles.img_print_dpi
+        if not dpi:
+            return img_path
+        key = (img_path, int(w), int(h))
+        try:
+            return self.resampled_images[key]
+        except KeyError:
+            pass
+        path = imageprep.resampleImage(img_path, w, h, dpi, cache=self.image_cache)
+        self.resampled_images[key] = path
+        return path
+
     def _fixBrokenImages(self, img_node, img_path):
         if img_path in self.fixed_images:
             return self.fixed_images[img_path]
-        self.fixed_images[img_path]=-1
-
-        try:
-            img = PilImage.open(img_path)
-        except IOError:
-            log.warning('image can not be opened by PIL: %r' % img_path)
-            return -1
-        cmds = []
-        base_cmd = [
-            'convert',
-            '-limit', 'memory', '32000000',
-            '-limit', 'map', '64000000',
-            '-limit', 'disk', '64000000',
-            '-limit', 'area', '64000000',
-            ]
-        if img.info.get('interlace', 0) == 1:
-            cmds.append(base_cmd + [img_path, '-interlace', 'none', img_path])
-        if img.mode == 'P': # ticket 324
-            cmds.append(base_cmd + [img_path, img_path]) # we esentially do nothing...but this seems to fix the problems
-        if img.mode == 'LA': # ticket 429
-            cleaned = PilImage.new('LA', img.size)
-            new_data = []
-            for pixel in img.getdata():
-                if pixel[1] == 0:
-                    new_data.append((255,0))
-                else:
-                    new_data.append(pixel)
-            cleaned.putdata(new_data)
-            cleaned.save(img_path)
-            img = PilImage.open(img_path)
-        if img.mode == 'RGBA':
-            # ticket 901, image: http://en.wikipedia.org/wiki/File:WiMAXArchitecture.svg
-            #correct preserving alpha:
-            #convert broken.png white1000.png -compose Multiply -composite +matte final.png
-            cmds.append(base_cmd+['-background', 'white',
-                                  '-alpha', 'Background',
-                                  '-alpha', 'off',
-                                  img_path,
-                                  img_path])
-
-        for cmd in cmds:
+        self.fixed_images[img_path] = ''
+        repaired_path = imageprep.repairImage(img_path, cache=self.image_cache)
+        self.fixed_images[img_path] = repaired_path
+        return repaired_path
+
+    def submitArticleImages(self, item, art):
+        """Convert the SVG images and repair the broken images of a parsed
+        article in the image pool. Called from the prefetch threads, so
+        the images are prepared while earlier articles are laid out. The
+        parsed tree includes the images inserted by templates.
+
+        @returns: list of pending imageprep.prepareImage results
+        """
+        if self.image_pool is None or not art or not getattr(item, 'images', None):
+            return []
+        results = []
+        for node in art.find(parser.ImageLink):
+            if node.colon or not node.target:
+                continue
             try:
-                ret = subprocess.call(cmd)
-                if ret != 0:
-                    log.warning("converting broken image failed (return code: %d): %r" % (ret, img_path))
-                    return ret
-            except OSError:
-                log.warning("converting broken image failed (OSError): %r" % img_path)
-                raise
-        try:
-            del img
-            img = PilImage.open(img_path)
-            d = img.load()
-        except:
-            log.warning('image can not be opened by PIL: %r' % img_path)
-            raise
-        self.fixed_images[img_path]=0
-        return 0
+                disk_path = item.images.getDiskPath(node.target, size=800)
+            except Exception:
+                continue
+            if not disk_path:
+                continue
+            # an image must not be repaired by two workers at the same time
+            self.image_lock.acquire()
+            try:
+                if disk_path in self.submitted_images:
+                    continue
+                self.submitted_images.add(disk_path)
+            finally:
+                self.image_lock.release()
+            results.append(self.image_pool.apply_async(imageprep.prepareImage, ((disk_path, self.image_cache),)))
+        return results
+
+    def collectArticleImages(self, results):
+        """Wait for the images submitted by submitArticleImages. Images
+        which are not prepared are handled during the layout."""
+        for result in results:
+            try:
+                disk_path, png_path, path, repaired_path = result.get()
+            except Exception, err:
+                log.warning('image preparation failed: %r' % err)
+                continue
+            if png_path is not None:
+                self.converted_svgs[disk_path] = png_path
+            if path is not None:
+                self.fixed_images[path] = repaired_path
 
     def set_svg_default_size(self, img_node):
         image_info = self.imgDB.imageinfo.get(img_node.full_target, {})
@@ -1403,23 +2438,27 @@ class RlWriter(object):
                 items.extend(self.write(node))
             return items
 
-        img_path = self.getImgPath(img_node.target)
+        img_path = source_path = self.getImgPath(img_node.target)
 
         if not img_path:
             if img_node.target == None:
                 img_node.target = ''
             log.warning('invalid image url (obj.target: %r)' % img_node.target)
+            self.addImageDep(img_node.target)
             return []
 
         try:
-            ret = self._fixBrokenImages(img_node, img_path)
-            if ret != 0:
+            repaired_path = self._fixBrokenImages(img_node, img_path)
+            if not repaired_path:
+                self.addImageDep(img_node.target, source_path)
                 return []
         except:
             import traceback
             traceback.print_exc()
             log.warning('image skipped')
+            self.addImageDep(img_node.target, source_path)
             return []
+        img_path = repaired_path
 
         max_width = self.colwidth
         if self.table_nesting > 0 and not max_width:
@@ -1434,7 +2473,15 @@ class RlWriter(object):
 
         self.set_svg_default_size(img_node)
 
-        w, h = self.image_utils.getImageSize(img_node, img_path, max_print_width=max_width, max_print_height=max_height)
+        info = image_info.info(img_path)
+        if info is None:
+            log.warning('image can not be opened: %r' % img_path)
+            self.addImageDep(img_node.target, source_path)
+            return []
+        w, h = self.image_utils.getImageSize(img_node, max_print_width=max_width, max_print_height=max_height,
+                                             img_size=info.size)
+        img_path = self.resampleImage(img_path, w, h)
+        self.addImageDep(img_node.target, source_path, img_path, (w, h))
 
         align = img_node.align
         if align in [None, 'none']:
@@ -1629,6 +2676,8 @@ class RlWriter(object):
 
 
     def _writeSourceInSourceMode(self, n, src_lang, lexer, font_size):
+        from pygments import highlight
+        from mwlib.rl.rlsourceformatter import ReportlabFormatter
         sourceFormatter = ReportlabFormatter(font_size=font_size, font_name='FreeMono', background_color='#eeeeee', line_numbers=False)
         sourceFormatter.encoding = 'utf-8'
         self.formatter.source_mode += 1
@@ -1657,18 +2706,6 @@ class RlWriter(object):
             return None
 
     def writeSource(self, n):
-        langMap = {'lisp': lexers.CommonLispLexer()} #custom Mapping between mw-markup source attrs to pygement lexers if get_lexer_by_name fails
-        def getLexer(name):
-            try:
-                return lexers.get_lexer_by_name(name)
-            except lexers.ClassNotFound:
-                lexer = langMap.get(name)
-                if lexer:
-                    return lexer
-                else:
-                    traceback.print_exc()
-                    log.error('unknown source code language: %s' % repr(name))
-                    return None
         src_lang = n.vlist.get('lang', '').lower()
         lexer = getLexer(src_lang)
         if lexer:
@@ -1680,7 +2717,7 @@ class RlWriter(object):
                 res = self._writeSourceInSourceMode(n, src_lang, lexer, font_size)
                 if res.__class__ != XPreformatted:
                     break
-                width, height = res.wrap(avail_width, pdfstyles.page_height)
+                width, height = wrap_cache.size(res, avail_width, pdfstyles.page_height)
                 font_size -= .5
             self.rtl = rtl
             if res:
@@ -1705,7 +2742,8 @@ class RlWriter(object):
 
     def writeReference(self, n, isLink=False):
         ref_name = n.attributes.get('name')
-        if not getattr(n, 'ref_num', None):
+        ref_num = self.ref_nums.get(id(n))
+        if not ref_num:
             if ref_name and not n.children:
                 ref_num = self.ref_name_map.get(ref_name, '')
             else:
@@ -1715,13 +2753,13 @@ class RlWriter(object):
                 self.references.append(i)
                 ref_num = len(self.references)
                 self.ref_name_map[ref_name] = ref_num
-            n.ref_num = ref_num
+            self.ref_nums[id(n)] = ref_num
         if getattr(n, 'no_display', False):
             return []
         if isLink:
             return ['[%s]' % len(self.references)]
         else:
-            return ['<super><font size="10">[%s]</font></super>' % n.ref_num]
+            return ['<super><font size="10">[%s]</font></super>' % ref_num]
 
     def writeReferenceList(self, n=None):
         if self.references:
@@ -1807,7 +2845,7 @@ class RlWriter(object):
 
         leaf = item.getFirstLeaf() # strip leading spaces from list items
         if leaf and hasattr(leaf, 'caption'):
-            leaf.caption = leaf.caption.lstrip()
+            self.lstrip_leaves.add(id(leaf))
         items = self.renderMixed(item, para_style=para_style, textPrefix=itemPrefix)
         # FIXME : handle stuff inside an item
         
@@ -1866,14 +2904,16 @@ class RlWriter(object):
 
     def renderCaption(self, table):
         res = []
-        for row in table.children[:]:
+        for row in table.children:
             if row.__class__ == advtree.Caption:
                 res = self.writeCaption(row)
-                table.removeChild(row) # this is slight a hack. we do this in order not to simplify cell-coloring code
-            elif row.__class__ != advtree.Row:
-                table.removeChild(row)
         return res
 
+    def inHeaderCell(self, node):
+        """Check if node is a direct child of a header cell"""
+        parent = node.parent
+        return parent is not None and parent.__class__ == advtree.Cell and getattr(parent, 'is_header', False)
+
     def writeCell(self, cell):
         elements = []
         elements.extend(self.renderCell(cell))
@@ -1894,8 +2934,6 @@ class RlWriter(object):
             elements.append(Spacer(0, 1))
         if getattr(cell, 'is_header', False):
             self.formatter.strong_style += 1
-            for c in cell.children:
-                c.is_header = True
         elements.extend(self.renderMixed(cell, text_style(in_table=self.table_nesting, text_align=align)))
 
         for i, e in enumerate(elements):
@@ -2037,6 +3075,8 @@ class RlWriter(object):
         table_data =[]
         #a = []
         for row in t.children:
+            if row.__class__ != advtree.Row: # the caption is rendered above
+                continue
             row_data = []
             #cell_idxs = []
             for cell_idx, cell in enumerate(row.children):
@@ -2175,8 +3215,10 @@ class RlWriter(object):
                 #]
 
     def writeTimeline(self, node):
+        from mwlib import timeline
         img_path = timeline.drawTimeline(node.timeline, self.tmpdir)
         if img_path:
+            self.addImageDep(None, path=img_path)
             # width and height should be parsed by the....parser and not guessed by the writer
             node.width = 180
             node.thumb = True
@@ -2199,10 +3241,26 @@ def writer(env, output,
     mathcache=None,
     lang=None,
     profile=None,
+    workers=None,
+    rendercache=None,
+    rendercachesize=None,
+    prefetch=None,
+    shards=None,
+    timing=None,
+    imageworkers=None,
+    imagecache=None,
+    imagecachesize=None,
 ):
 
 
-    r = RlWriter(env, strict=strict, debug=debug, mathcache=mathcache, lang=lang)
+    r = RlWriter(env, strict=strict, debug=debug, mathcache=mathcache, lang=lang,
+                 workers=int(workers or 1),
+                 rendercache=rendercache, rendercache_size=int(rendercachesize or 1024),
+                 prefetch_threads=int(prefetch or 4),
+                 shards=int(shards or 1),
+                 timing=timing,
+                 image_workers=int(imageworkers if imageworkers is not None else 4),
+                 imagecache=imagecache, imagecache_size=int(imagecachesize or 1024))
     if coverimage is None and env.configparser.has_section('pdf'):
         coverimage = env.configparser.get('pdf', 'coverimage', None)
 
@@ -2241,4 +3299,40 @@ writer.options = {
         'param': 'PROFILEFN',
         'help': 'profile run time. ONLY for debugging purposes',
     },
+    'workers': {
+        'param': 'NUM',
+        'help': 'number of worker processes used to lay out articles (defaults to 1)',
+    },
+    'rendercache': {
+        'param': 'DIRNAME',
+        'help': 'directory of cached article layouts (defaults to $MWLIBRL_RENDERCACHE)',
+    },
+    'rendercachesize': {
+        'param': 'MB',
+        'help': 'size limit of the render cache in megabytes (defaults to 1024)',
+    },
+    'prefetch': {
+        'param': 'NUM',
+        'help': 'number of threads used to fetch upcoming articles (defaults to 4)',
+    },
+    'shards': {
+        'param': 'NUM',
+        'help': 'render huge books in NUM parallel parts which are stitched together (needs pdftk)',
+    },
+    'timing': {
+        'param': 'FILENAME',
+        'help': 'write time spent per node type and article as JSON (defaults to $MWLIBRL_TIMING)',
+    },
+    'imageworkers': {
+        'param': 'NUM',
+        'help': 'number of processes which convert and repair images before layout, 0 to do it during layout (defaults to 4)',
+    },
+    'imagecache': {
+        'param': 'DIRNAME',
+        'help': 'directory of cached converted and repaired images (defaults to $MWLIBRL_IMAGECACHE)',
+    },
+    'imagecachesize': {
+        'param': 'MB',
+        'help': 'size limit of the image cache in megabytes (defaults to 1024)',
+    },
 }
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Helpers to render a book in shards and stitch them together.
+
+Every shard is rendered to its own PDF without page numbers by the LaTeX
+document template. The shards are concatenated with pdftk, the page
+numbers are stamped onto the result in a second pass and the outline of
+the whole book is attached.
+"""
+
+import os
+import subprocess
+
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import cm
+
+from mwlib.rl.pdfstyles import page_width, page_height, serif_font
+
+
+def pdftk(args):
+    try:
+        p = subprocess.Popen(['pdftk'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError, err:
+        raise RuntimeError('pdftk not found: %r' % err)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('pdftk failed with returncode %d: %s' % (p.returncode, err))
+    return out
+
+
+def havePdftk():
+    try:
+        pdftk(['--version'])
+    except RuntimeError:
+        return False
+    return True
+
+
+def countPages(pdfpath):
+    for line in pdftk([pdfpath, 'dump_data']).splitlines():
+        if line.startswith('NumberOfPages:'):
+            return int(line.split(':', 1)[1])
+    raise RuntimeError('could not count pages of %r' % pdfpath)
+
+
+def concatenate(pdfpaths, outpath):
+    pdftk(list(pdfpaths) + ['cat', 'output', outpath])
+
+
+def stampPageNumbers(pdfpath, page_numbers, outpath):
+    """Stamp page numbers onto the pages of pdfpath. They are centered
+    in the bottom margin, where LaTeX puts them.
+
+    @param page_numbers: map of physical page (starting at 1) to page
+    number. Pages which are not in the map stay unnumbered.
+    """
+    num_pages = countPages(pdfpath)
+    numberspath = outpath + '.numbers.pdf'
+    c = canvas.Canvas(numberspath, pagesize=(page_width, page_height))
+    for page in range(1, num_pages + 1):
+        if page in page_numbers:
+            number = page_numbers[page]
+            c.setFont(serif_font, 10)
+            c.drawCentredString(page_width / 2, 1.5 * cm, '%d' % number)
+        c.showPage()
+    c.save()
+    try:
+        pdftk([pdfpath, 'multistamp', numberspath, 'output', outpath])
+    finally:
+        os.unlink(numberspath)
+
+
+def setOutline(pdfpath, outline, outpath):
+    """Replace the outline of pdfpath.
+
+    @param outline: list of (title, level, page) tuples. levels and
+    pages start at 1
+    """
+    infopath = outpath + '.info'
+    f = open(infopath, 'w')
+    try:
+        for (title, level, page) in outline:
+            if isinstance(title, str):
+                title = title.decode('utf-8', 'replace')
+            f.write('BookmarkBegin\n')
+            f.write('BookmarkTitle: %s\n' % u' '.join(title.split()).encode('utf-8'))
+            f.write('BookmarkLevel: %d\n' % level)
+            f.write('BookmarkPageNumber: %d\n' % page)
+    finally:
+        f.close()
+    try:
+        pdftk([pdfpath, 'update_info_utf8', infopath, 'output', outpath])
+    finally:
+        os.unlink(infopath)
@@ -20,14 +20,20 @@ from mwlib.rl import fontconfig
 class TocRenderer(object):
 
     def __init__(self):
+        self.fonts_registered = False
+
+    def registerFonts(self):
+        if self.fonts_registered:
+            return
         font_switcher = fontconfig.RLFontSwitcher()
         font_switcher.font_paths = fontconfig.font_paths
         font_switcher.registerDefaultFont(pdfstyles.default_font)
         font_switcher.registerFontDefinitionList(fontconfig.fonts)
         font_switcher.registerReportlabFonts(fontconfig.fonts)
+        self.fonts_registered = True
 
-        
     def build(self, pdfpath, toc_entries, has_title_page=False, rtl=False):
+        self.registerFonts()
         outpath = os.path.dirname(pdfpath)
         tocpath = os.path.join(outpath, 'toc.pdf')
         finalpath = os.path.join(outpath, 'final.pdf')
@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+#! -*- coding:utf-8 -*-
+
+# Copyright (c) 2007, PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Cache of the sizes of wrapped flowables.
+
+The layout heuristics measure the same text at the same width more than
+once: preformatted text is wrapped while its font size is chosen and
+again when the elements are grouped, and the same blocks show up in
+many articles. The sizes are keyed by the class, the text and the font
+of a flowable and the available width. The available height is not part
+of the key, it doesn't change the size a flowable wraps to.
+
+A hit does not wrap the flowable, the cache is only meant for measuring.
+"""
+
+from mwlib.rl.lrucache import LRUCache
+
+
+class WrapCache(object):
+
+    def __init__(self, max_entries=4096):
+        self._sizes = LRUCache(max_entries=max_entries) # key -> (width, height)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, flowable, width):
+        """Cache key of flowable wrapped to width, None if the size can't
+        be told from its content"""
+        text = getattr(flowable, 'text', None)
+        if not isinstance(text, basestring):
+            return None
+        style = getattr(flowable, 'style', None)
+        if style is not None:
+            style = (getattr(style, 'fontName', None), getattr(style, 'fontSize', None),
+                     getattr(style, 'leading', None))
+        return (flowable.__class__, text, style, width)
+
+    def size(self, flowable, width, height):
+        """Size of flowable wrapped to width x height"""
+        key = self.key(flowable, width)
+        if key is not None:
+            size = self._sizes.get(key)
+            if size is not None:
+                self.hits += 1
+                return size
+        self.misses += 1
+        size = flowable.wrap(width, height)
+        if key is not None:
+            self._sizes.put(key, size)
+        return size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else 0.0,
+                }
+
+
+# shared by all layout heuristics of a process
+wrap_cache = WrapCache()
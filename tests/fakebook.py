@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2007-2008 PediaPress GmbH
+# See README.txt for additional licensing information.
+
+"""Fake environment of a book, shared by the tests and benchmarks/.
+
+The articles are parsed from wikitext and images are generated on
+first access, nothing is fetched.
+"""
+
+import os
+import ConfigParser
+
+
+class FakeSource(object):
+    url = u'http://test.example.org/w/'
+
+
+class FakeWiki(object):
+    """Parses the articles (title -> wikitext) and answers the meta data
+    queries of the writer"""
+
+    def __init__(self, articles):
+        self.articles = articles
+        self.siteinfo = {'general': {'server': u'http://test.example.org'}}
+
+    def getParsedArticle(self, title, revision=None):
+        from mwlib import uparser
+        return uparser.parseString(title=title, raw=self.articles[title])
+
+    def getURL(self, title, revision=None):
+        return u'http://test.example.org/wiki/%s' % title.replace(' ', '_')
+
+    def getSource(self, title, revision=None):
+        return FakeSource()
+
+    def getAuthors(self, title, revision=None):
+        return [u'Tester']
+
+
+class FakeImageDB(object):
+    """Generates an image on first access, see renderhelper.dummyImageDB"""
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.imageinfo = {}
+
+    def getDiskPath(self, name, size=None):
+        from PIL import Image, ImageDraw
+        path = os.path.join(self.basedir, name.replace('/', '_'))
+        if not os.path.exists(path):
+            img = Image.new('RGB', (400, 300), (255, 0, 0))
+            d = ImageDraw.Draw(img)
+            d.rectangle([(50, 50), (350, 250)], fill=(0, 255, 0))
+            img.save(path)
+        return path
+
+    def getDescriptionURL(self, name):
+        return None
+
+    def getURL(self, name):
+        return None
+
+    def getContributors(self, name, wikidb=None):
+        return []
+
+    def getImageTemplates(self, name, wikidb=None):
+        return []
+
+    def getImageTemplatesAndArgs(self, name, wikidb=None):
+        return []
+
+
+class FakeItem(object):
+    def __init__(self, type, title, wiki=None, images=None):
+        self.type = type
+        self.title = title
+        self.displaytitle = None
+        self.revision = None
+        self.wiki = wiki
+        self.images = images
+
+
+class FakeMetabook(object):
+    def __init__(self, title, items):
+        self.title = title
+        self.subtitle = u''
+        self.items = items
+
+    def walk(self):
+        return list(self.items)
+
+    def articles(self):
+        return [item for item in self.items if item.type == 'article']
+
+
+class FakeEnv(object):
+    """Environment of a book of the articles (title -> wikitext).
+
+    The chapters precede the articles, unless items gives the metabook
+    as a list of (type, title) tuples.
+    """
+
+    def __init__(self, articles, chapters=(), images=None, items=None, title=u'Test Book'):
+        self.wiki = FakeWiki(articles)
+        self.images = images
+        if items is None:
+            items = [('chapter', t) for t in chapters]
+            items.extend(('article', t) for t in sorted(articles))
+        self.metabook = FakeMetabook(title, [self._item(type, t) for (type, t) in items])
+        self.configparser = ConfigParser.ConfigParser()
+
+    def _item(self, type, title):
+        if type == 'article':
+            return FakeItem(type, title, wiki=self.wiki, images=self.images)
+        return FakeItem(type, title)
+
+    def getLicenses(self):
+        return []
+
+
+class FakeStatus(object):
+    def __call__(self, **kw):
+        pass
+
+    def getSubRange(self, start, end):
+        return self
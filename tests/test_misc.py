@@ -5,6 +5,7 @@
 # See README.txt for additional licensing information.
 
 from mwlib.rl.rlwriter import RlWriter
+from fakebook import FakeEnv, FakeStatus
 
 def writer():
 
@@ -30,3 +31,489 @@ def test_fakeHyphenate():
         res = r.renderText(txt, break_long=True)
         assert res.find('<font') == -1
     
+
+def test_writeDoesNotModifyTree():
+    from mwlib import uparser, advtree
+    from mwlib.treecleaner import TreeCleaner
+    raw = '''
+== Section ==
+Some text<ref>a reference</ref> and more<ref>another one</ref>.
+*  an item
+
+{|
+|+ caption
+! header cell
+|-
+| cell
+|}
+
+<references/>
+'''
+    tree = uparser.parseString(title='Test', raw=raw)
+    advtree.buildAdvancedTree(tree)
+    TreeCleaner(tree).cleanAll()
+
+    def snapshot(node):
+        return [(n.__class__, getattr(n, 'caption', None), len(n.children)) for n in node.allchildren()]
+
+    def printed(elements):
+        # like BaseDocTemplate.build, skip the elements that can't be printed
+        res = []
+        for e in elements:
+            try:
+                res.append(unicode(e))
+            except AttributeError:
+                pass
+        return res
+
+    before = snapshot(tree)
+    r = writer()
+    r.wikiTitle = 'testwiki'
+    first = printed(r.write(tree))
+    assert snapshot(tree) == before
+    # references are numbered and the list item is stripped through the side tables
+    assert sorted(r.ref_nums.values()) == [1, 2]
+    assert r.lstrip_leaves
+    r2 = writer() # a fresh writer, bookmark anchors are numbered per writer
+    r2.wikiTitle = 'testwiki'
+    second = printed(r2.write(tree))
+    assert snapshot(tree) == before
+    assert first == second
+    assert [e for e in first if '[2]' in e]
+    # the leading spaces of the item are stripped when it is written, not in the tree
+    item_leaf = [n for n in tree.allchildren() if n.__class__ is advtree.Item][0].getFirstLeaf()
+    assert id(item_leaf) in r.lstrip_leaves
+    assert item_leaf.caption.startswith(' ')
+
+
+# stand-ins for the flowables used by floatImages
+class FakeStyle(object):
+    def __init__(self, name='text', flowable=True):
+        self.name = name
+        self.flowable = flowable
+        self.spaceBefore = 0
+        self.spaceAfter = 6
+        self.leading = 12
+
+
+class FakeParagraph(object):
+    def __init__(self, name, lines, style=None):
+        self.name = name
+        self.lines = lines
+        self.style = style or FakeStyle()
+        self.wraps = 0
+
+    def wrap(self, availWidth, availHeight):
+        self.wraps += 1
+        # lines are 100pt wide
+        return availWidth, self.style.leading * max(1, self.lines * 100 // int(availWidth))
+
+
+class FakeFigure(object):
+    def __init__(self, name, width, height, float_figure=True, align=None):
+        self.name = name
+        self.imgWidth = width
+        self.imgHeight = height
+        self.float_figure = float_figure
+        self.align = align
+        self.margin = (0, 0, 0, 0)
+        self.padding = (2, 2, 2, 2)
+        self.cs = FakeStyle()
+        self.captionTxt = 'caption'
+
+
+class FakeFiguresAndParagraphs(object):
+    def __init__(self, figures, paragraphs, figure_margin=None, rtl=False):
+        self.figures = figures
+        self.paragraphs = paragraphs
+
+
+class FakeSpacer(object):
+    def __init__(self, width, height):
+        self.name = 'spacer'
+
+
+def names(nodes):
+    res = []
+    for n in nodes:
+        if isinstance(n, FakeFiguresAndParagraphs):
+            res.append(([f.name for f in n.figures], [p.name for p in n.paragraphs]))
+        else:
+            res.append(n.name)
+    return res
+
+
+def floatTestNodes():
+    heading = FakeStyle(name='heading_style_section')
+    return [FakeParagraph('p1', 5),
+            FakeFigure('f1', 150, 200),
+            FakeParagraph('p2', 10),
+            FakeParagraph('p3', 50),
+            FakeParagraph('p4', 10),
+            FakeFigure('f2', 100, 100),
+            FakeFigure('f3', 200, 150),
+            FakeParagraph('p5', 2),
+            FakeParagraph('h1', 1, style=heading),
+            FakeParagraph('p6', 3, style=FakeStyle(flowable=False)),
+            FakeFigure('f4', 100, 300, align='left'),
+            FakeParagraph('p7', 8),
+            FakeFigure('f5', 100, 100, float_figure=False),
+            FakeParagraph('p8', 40),
+            FakeFigure('f6', 120, 80),
+            FakeParagraph('p9', 4),
+            ]
+
+
+def test_floatImagesGrouping(monkeypatch):
+    from mwlib.rl import rlwriter
+    monkeypatch.setattr(rlwriter, 'Paragraph', FakeParagraph)
+    monkeypatch.setattr(rlwriter, 'Figure', FakeFigure)
+    monkeypatch.setattr(rlwriter, 'FiguresAndParagraphs', FakeFiguresAndParagraphs)
+    monkeypatch.setattr(rlwriter, 'Spacer', FakeSpacer, raising=False)
+    monkeypatch.setattr(rlwriter, 'cm', 1, raising=False)
+    monkeypatch.setattr(rlwriter, 'print_width', 480)
+    monkeypatch.setattr(rlwriter, 'print_height', 700)
+    nodes = floatTestNodes()
+    res = writer().floatImages(nodes)
+    assert names(res) == ['p1', (['f1'], ['p2', 'p3']), 'p4', (['f2', 'f3'], ['p5']),
+                          'h1', 'p6', (['f4'], ['p7']), 'f5', 'p8', (['f6'], ['p9'])]
+    # every paragraph is measured at most once
+    assert max(n.wraps for n in nodes if isinstance(n, FakeParagraph)) <= 1
+
+
+def test_imageInfoFollowsRewrites(tmpdir):
+    from PIL import Image as PilImage
+    from mwlib.rl.imageinfo import ImageInfoCache
+    path = str(tmpdir.join('img.png'))
+    PilImage.new('P', (40, 20)).save(path)
+    cache = ImageInfoCache()
+    info = cache.info(path)
+    assert (info.size, info.mode, info.format) == ((40, 20), 'P', 'PNG')
+    assert cache.info(path) is info
+    PilImage.new('RGB', (40, 20)).save(path)
+    cache.invalidate(path)
+    assert cache.info(path).mode == 'RGB'
+    assert cache.info(str(tmpdir.join('missing.png'))) is None
+
+
+def test_writeBookWithoutFailSafe(tmpdir):
+    articles = {}
+    for num in range(3):
+        articles[u'Article %d' % num] = u'Intro of article %d.\n\n== Section ==\nText with a [[Article 0|link]].' % num
+    r = RlWriter(FakeEnv(articles, chapters=[u'Chapter']))
+    output = str(tmpdir.join('book.pdf'))
+    r.writeBook(output, status_callback=FakeStatus())
+    assert not r.fail_safe_rendering
+    assert tmpdir.join('book.pdf').check()
+    tex = tmpdir.join('book.pdf.tex').read()
+    for num in range(3):
+        assert 'Intro of article %d' % num in tex
+
+
+def test_articleCacheKeyIgnoresWriteDirection(monkeypatch):
+    from mwlib.rl import rlwriter
+    r = RlWriter(FakeEnv({u'Article': u'Text'}))
+    item = r.env.metabook.articles()[0]
+    key = r.articleCacheKey(item)
+    r.set_rtl(True) # a node with dir="rtl" is being written
+    assert r.articleCacheKey(item) == key
+    r.set_rtl(False)
+    monkeypatch.setattr(rlwriter, 'mwlibversion', '0.0.0')
+    assert r.articleCacheKey(item) != key
+
+
+def test_writeArticleResetsWikiurl(monkeypatch):
+    from mwlib import uparser, advtree
+    article = uparser.parseString(title='Test', raw='Some text.')
+    advtree.buildAdvancedTree(article)
+    article.wikiurl = u'http://test.example.org/w/'
+    r = writer()
+
+    def fail(*args, **kwargs):
+        assert r.article_wikiurl == article.wikiurl
+        raise ValueError('layout failed')
+    monkeypatch.setattr(r, 'renderMixed', fail)
+    try:
+        r.writeArticle(article)
+    except ValueError:
+        pass
+    else:
+        assert False, 'renderMixed was not called'
+    assert r.article_wikiurl == ''
+
+
+def test_diskCacheEntriesAreShared(tmpdir, monkeypatch):
+    import os
+    import stat
+    from mwlib.rl import diskcache
+    monkeypatch.setattr(diskcache, '_umask', 022)
+    cache = diskcache.DiskCache(str(tmpdir))
+    path = cache.put('abcdef', 'data')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0644
+    src = tmpdir.join('src')
+    src.write('data')
+    path = cache.putFile('012345', str(src))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0644
+    assert cache.get('012345') == 'data'
+
+
+def test_repairedImagesKeepTheirExtension(tmpdir):
+    from PIL import Image as PilImage
+    from mwlib.rl import imageprep
+    from mwlib.rl.diskcache import DiskCache
+    cache = DiskCache(str(tmpdir.join('cache')))
+    for i in range(2): # the second repair is taken from the cache
+        path = str(tmpdir.join('img%d.gif' % i))
+        PilImage.new('RGB', (40, 20), (255, 0, 0)).convert('P').save(path)
+        repaired = imageprep.repairImage(path, cache=cache)
+        assert repaired == path + '.png'
+        assert PilImage.open(repaired).format == 'PNG'
+        assert PilImage.open(repaired).mode == 'RGB'
+        assert PilImage.open(path).format == 'GIF'
+    assert cache.hits == 1
+    path = str(tmpdir.join('img.png'))
+    PilImage.new('RGB', (40, 20)).save(path)
+    assert imageprep.repairImage(path, cache=cache) == path
+    tmpdir.join('broken.jpg').write('no image')
+    assert imageprep.repairImage(str(tmpdir.join('broken.jpg'))) == ''
+
+
+def test_shardedBookFallsBackWhenSpoolingFails(tmpdir, monkeypatch):
+    from mwlib.rl import rlwriter, shards
+    from mwlib.rl.pipeline import ElementSpool
+    monkeypatch.setattr(shards, 'havePdftk', lambda: True)
+    append = ElementSpool.append
+
+    def failingAppend(self, info, elements):
+        if len(self) == 2: # front matter and chapter are spooled
+            raise IOError('disk full')
+        return append(self, info, elements)
+    monkeypatch.setattr(ElementSpool, 'append', failingAppend)
+
+    def renderShard(*args):
+        assert False, 'shards rendered from an incomplete spool'
+    monkeypatch.setattr(rlwriter, '_renderShardInWorker', renderShard)
+    articles = dict((u'Article %d' % num, u'Text of article %d.' % num) for num in range(3))
+    r = RlWriter(FakeEnv(articles, chapters=[u'Chapter']), shards=2)
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=FakeStatus())
+    assert not r.fail_safe_rendering
+    tex = tmpdir.join('book.pdf.tex').read()
+    assert tex.index('Chapter') < tex.index('Text of article 0')
+    for num in range(3):
+        assert 'Text of article %d' % num in tex
+
+
+def test_imagesArePreparedFromTheParsedTree(tmpdir, monkeypatch):
+    from mwlib import uparser
+    from mwlib.templ.misc import DictDB
+    from fakebook import FakeImageDB
+
+    env = FakeEnv({u'Article': u'{{Pic}}\n\nSome text.\n\n[[Image:Direct.png|thumb|direct]]\n\nMore text.'},
+                  images=FakeImageDB(str(tmpdir)))
+    assert not hasattr(env.wiki, 'getRawArticle')
+    class TemplateDB(DictDB):
+        def getURL(self, title, revision=None):
+            return None
+    templates = TemplateDB({u'Pic': u'[[Image:Templated.png|thumb|from a template]]'})
+
+    def getParsedArticle(title, revision=None):
+        return uparser.parseString(title=title, raw=env.wiki.articles[title], wikidb=templates)
+    monkeypatch.setattr(env.wiki, 'getParsedArticle', getParsedArticle)
+    r = RlWriter(env, image_workers=2)
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=FakeStatus())
+    assert not r.fail_safe_rendering
+    for name in ['Image:Direct.png', 'Image:Templated.png']:
+        path = str(tmpdir.join(name))
+        assert path in r.submitted_images
+        assert path in r.fixed_images
+
+
+def test_articlePipelineKeepsTheWikiOffTheWorkerThreads(tmpdir):
+    import threading
+    articles = dict((u'Article %d' % i, u'Text of article %d.' % i) for i in range(6))
+    env = FakeEnv(articles)
+    main_thread = threading.currentThread()
+    calls = {'active': 0, 'max': 0, 'authors': []}
+    wiki_lock = threading.Lock()
+    getParsedArticle = env.wiki.getParsedArticle
+    def parse(title, revision=None):
+        wiki_lock.acquire()
+        calls['active'] += 1
+        calls['max'] = max(calls['max'], calls['active'])
+        wiki_lock.release()
+        try:
+            return getParsedArticle(title, revision=revision)
+        finally:
+            calls['active'] -= 1
+    def getAuthors(title, revision=None):
+        calls['authors'].append(threading.currentThread() is main_thread)
+        return [u'Tester']
+    env.wiki.getParsedArticle = parse
+    env.wiki.getAuthors = getAuthors
+    r = RlWriter(env, prefetch_threads=4)
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=FakeStatus())
+    assert calls['max'] == 1
+    assert calls['authors'] == [True] * len(articles)
+    assert not [t for t in threading.enumerate() if t.getName() == 'prepare']
+
+
+def test_transformCSSOnlyStylesMatchingClasses():
+    from mwlib import uparser
+    from mwlib.rl.customnodetransformer import CustomNodeTransformer
+    cnt = CustomNodeTransformer({'note': 'font-weight: bold; color: red', 'unused': ''})
+    assert cnt.css_styles == {'note': {'font-weight': 'bold', 'color': 'red'}}
+    art = uparser.parseString(title='Test', raw='<div class="other note">a</div><div class="other">b</div>')
+    cnt.transformCSS(art)
+    styled = [n for n in art.allchildren() if n.vlist.get('style')]
+    assert len(styled) == 1
+    assert styled[0].vlist['style']['color'] == 'red'
+    art = uparser.parseString(title='Test', raw='<div class="other">b</div>')
+    cnt.transformCSS(art)
+    assert not [n for n in art.allchildren() if n.vlist.get('style')]
+
+
+def test_wrapCacheIsKeyedByContentAndWidth():
+    from mwlib.rl.wrapcache import WrapCache
+    from mwlib.rl.latexelements import XPreformatted
+    from mwlib.rl.pdfstyles import text_style
+    cache = WrapCache()
+    style = text_style(mode='preformatted')
+    size = cache.size(XPreformatted(u'some\ncode', style), 400, 800)
+    assert cache.size(XPreformatted(u'some\ncode', style), 400, 100) == size
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.size(XPreformatted(u'some\ncode', style), 300, 800)
+    style.fontSize -= 1
+    assert cache.size(XPreformatted(u'some\ncode', style), 400, 800)[0] < size[0]
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_latexBookReportsTocPagesAndProgress(tmpdir, monkeypatch):
+    import re
+    import texcaller
+    def convert(content, src, dst, runs):
+        # every entry ends up on a page of its own, starting with page 2
+        markers = re.findall(r'\\write16\{mwlib-toc (\d+) \\thepage\}', content)
+        log = ['mwlib-toc %s %d' % (idx, 2 + i) for (i, idx) in enumerate(markers)]
+        log.append('Output written on texput.pdf (9 pages, 1234 bytes).')
+        return '%PDF-1.4 stub\n', '\n'.join(log)
+    monkeypatch.setattr(texcaller, 'convert', convert)
+    class Status(FakeStatus):
+        calls = []
+        def __call__(self, **kw):
+            self.calls.append(kw)
+    articles = dict((u'Article %d' % i, u'Text of article %d.' % i) for i in range(2))
+    r = RlWriter(FakeEnv(articles, chapters=[u'Chapter']))
+    toc = []
+    monkeypatch.setattr(r.toc_renderer, 'build', lambda output, entries, **kw: toc.extend(entries))
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=Status())
+    assert not r.fail_safe_rendering
+    # followed by the appendix
+    assert toc[:4] == [('group', u'Articles', 2), ('chapter', u'Chapter', 3),
+                       ('article', u'Article 0', 4), ('article', u'Article 1', 5)]
+    assert {'progress': 100, 'page': 9} in Status.calls
+    assert '\\pdfinfo{/Keywords (mwlib version' in tmpdir.join('book.pdf.tex').read()
+
+
+def test_cachedLayoutsFollowTheImagesOfTheJob(tmpdir):
+    from PIL import Image
+    from fakebook import FakeImageDB
+    articles = {u'Article': u'Some text.\n\n[[Image:Pic.png|thumb|a picture]]\n\nMore text.'}
+    def render(name):
+        imgdir = tmpdir.mkdir(name)
+        if name == 'changed':
+            Image.new('RGB', (400, 300), (0, 0, 255)).save(str(imgdir.join('Image:Pic.png')))
+        r = RlWriter(FakeEnv(articles, images=FakeImageDB(str(imgdir))),
+                     rendercache=str(tmpdir.join('cache')))
+        laid_out = []
+        layoutPreparedArticle = r.layoutPreparedArticle
+        def layout(item, *args, **kwargs):
+            laid_out.append(item.title)
+            return layoutPreparedArticle(item, *args, **kwargs)
+        r.layoutPreparedArticle = layout
+        output = str(tmpdir.join('%s.pdf' % name))
+        r.writeBook(output, status_callback=FakeStatus())
+        assert not r.fail_safe_rendering
+        return laid_out, open(output + '.tex').read()
+    laid_out, tex = render('first')
+    assert laid_out == [u'Article']
+    laid_out, tex = render('second')
+    assert laid_out == []
+    assert str(tmpdir.join('second')) in tex
+    assert str(tmpdir.join('first')) not in tex
+    laid_out, tex = render('changed')
+    assert laid_out == [u'Article']
+
+
+def test_shardedBookIsStitchedInOrder(tmpdir, monkeypatch):
+    import os
+    import re
+    import shutil
+    import texcaller
+    from mwlib.rl import shards
+
+    def convert(content, src, dst, runs):
+        # every TocEntry starts a new page
+        log, page = [], 1
+        for (kind, key) in re.findall(r'\\write16\{mwlib-(toc|dest) (\S+) \\thepage\}', content):
+            if kind == 'toc':
+                page += 1
+            log.append('mwlib-%s %s %d' % (kind, key, page))
+        log.append('Output written on texput.pdf (%d pages, 1234 bytes).' % page)
+        return '%%PDF-1.4 stub pages=%d\n' % page, '\n'.join(log)
+
+    def countPages(path):
+        return int(re.search(r'pages=(\d+)', open(path).read()).group(1))
+
+    stitched = {}
+    def concatenate(paths, outpath):
+        stitched['shards'] = [os.path.basename(p) for p in paths]
+        open(outpath, 'w').write('%%PDF-1.4 stub pages=%d\n' % sum(countPages(p) for p in paths))
+    def stampPageNumbers(pdfpath, page_numbers, outpath):
+        stitched['page_numbers'] = page_numbers
+        shutil.copyfile(pdfpath, outpath)
+    def setOutline(pdfpath, outline, outpath):
+        stitched['outline'] = outline
+        shutil.copyfile(pdfpath, outpath)
+
+    monkeypatch.setattr(texcaller, 'convert', convert)
+    monkeypatch.setattr(shards, 'havePdftk', lambda: True)
+    for func in [countPages, concatenate, stampPageNumbers, setOutline]:
+        monkeypatch.setattr(shards, func.__name__, func)
+    articles = dict((u'Article %d' % i, u'Text of article %d.' % i) for i in range(4))
+    r = RlWriter(FakeEnv(articles), shards=2)
+    toc = []
+    monkeypatch.setattr(r.toc_renderer, 'build', lambda output, entries, **kw: toc.extend(entries))
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=FakeStatus())
+    assert not r.fail_safe_rendering
+    assert stitched['shards'] == ['shard0.pdf', 'shard1.pdf']
+    num_pages = countPages(str(tmpdir.join('book.pdf')))
+    assert stitched['page_numbers'] == dict((page, page) for page in range(1, num_pages + 1))
+    toc_articles = [(txt, page) for (lvl, txt, page) in toc if txt in articles]
+    assert [txt for (txt, page) in toc_articles] == [u'Article %d' % i for i in range(4)]
+    pages = [page for (txt, page) in toc_articles]
+    assert pages == sorted(set(pages)) and pages[-1] <= num_pages
+    outline_articles = [(title, page) for (title, lvl, page) in stitched['outline'] if title in articles]
+    assert outline_articles == toc_articles
+
+
+def test_recoveredArticlesKeepTheirOutlineEntries(tmpdir, monkeypatch):
+    import texcaller
+    calls = []
+    def convert(content, src, dst, runs):
+        calls.append(content)
+        if len(calls) == 1:
+            raise RuntimeError('LaTeX failed')
+        return '%PDF-1.4 stub\n', ''
+    monkeypatch.setattr(texcaller, 'convert', convert)
+    articles = dict((u'Article %d' % i, u'Text of article %d.' % i) for i in range(3))
+    r = RlWriter(FakeEnv(articles, chapters=[u'Chapter']))
+    failed_idx = [idx for (idx, info) in enumerate(r.env.metabook.walk()) if info.title == u'Article 1'][0]
+    def findFailedArticles():
+        return [idx for (idx, info) in enumerate(r.spool.info) if info[1] == failed_idx]
+    monkeypatch.setattr(r, 'findFailedArticles', findFailedArticles)
+    r.writeBook(str(tmpdir.join('book.pdf')), status_callback=FakeStatus())
+    assert r.fail_safe_rendering
+    titles = [title for (title, bm_type, key) in r.doc.bookmarks if bm_type == 'article']
+    assert titles[:3] == [u'Article 0', u'Article 1', u'Article 2']
+    keys = [key for (title, bm_type, key) in r.doc.bookmarks if title == u'Article 1']
+    assert keys == ['f%d.0' % failed_idx]